@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+from datastructures import StreamContainer
+from log import log_general
+
+# Columnar OHLCV archive for backtests, one directory per interval:
+#   <root>/<interval>/unixtime.npy            int64, every token's bars back to back, ascending unixtime within a token
+#   <root>/<interval>/{open,high,...}.npy     float64, aligned with unixtime
+#   <root>/<interval>/index.json              {token_address: [start_row, end_row)}
+# Files are plain .npy so they open with np.load(mmap_mode='r') and every slice is a zero-copy view of the page cache.
+
+OHLCV_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+def export_interval(db_path, root, interval, chunk_size=65536) -> int:
+    """ Writes the interval's candles from tradeable_asset_prices into a fresh archive directory and swaps it in; returns the bar count """
+    conn = sqlite3.connect(db_path)
+    try:
+        counts = conn.execute('''SELECT token_address, COUNT(*) FROM tradeable_asset_prices
+                                 WHERE interval = ? GROUP BY token_address ORDER BY token_address''', (interval,)).fetchall()
+        index, total = {}, 0
+        for token_address, count in counts:
+            index[token_address] = [total, total + count]
+            total += count
+
+        target = os.path.join(root, interval)
+        staging = f"{target}.staging"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        columns = {'unixtime': np.lib.format.open_memmap(os.path.join(staging, 'unixtime.npy'), mode='w+', dtype=np.int64, shape=(total,))}
+        for column in OHLCV_COLUMNS:
+            columns[column] = np.lib.format.open_memmap(os.path.join(staging, f'{column}.npy'), mode='w+', dtype=np.float64, shape=(total,))
+
+        # one primary key range scan per token, streamed straight into the mapped files
+        for token_address, (start, end) in index.items():
+            cursor = conn.execute('''SELECT unixtime, open, high, low, close, volume FROM tradeable_asset_prices
+                                     WHERE token_address = ? AND interval = ? ORDER BY unixtime ASC''', (token_address, interval))
+            row = start
+            while rows := cursor.fetchmany(chunk_size):
+                block = np.array(rows, dtype=np.float64)
+                columns['unixtime'][row:row + len(rows)] = block[:, 0].astype(np.int64)
+                for position, column in enumerate(OHLCV_COLUMNS, start=1):
+                    columns[column][row:row + len(rows)] = block[:, position]
+                row += len(rows)
+            if row != end:
+                raise ValueError(f"{token_address} {interval} changed during export: expected {end - start} bars, read {row - start}")
+    finally:
+        conn.close()
+
+    for array in columns.values():
+        array.flush()
+    del columns
+    with open(os.path.join(staging, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    retired = f"{target}.retired"
+    shutil.rmtree(retired, ignore_errors=True)
+    if os.path.exists(target):
+        os.rename(target, retired)
+    os.rename(staging, target)
+    shutil.rmtree(retired, ignore_errors=True)
+    log_general.info(f"Archived {total} {interval} candles for {len(index)} tokens to {target}")
+    return total
+
+class OHLCVArchive:
+    """ Read-only, memory-mapped view of one interval of an archive written by export_interval """
+    __slots__ = ['interval', 'index', 'columns']
+
+    def __init__(self, root, interval):
+        path = os.path.join(root, interval)
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index : dict[str, list] = json.load(f)
+        self.interval = interval
+        self.columns = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in ['unixtime'] + OHLCV_COLUMNS}
+
+    def __contains__(self, token_address):
+        return token_address in self.index
+
+    @property
+    def tokens(self) -> list[str]:
+        return list(self.index)
+
+    def rows(self, token_address, unixtimestart=None, unixtimeend=None) -> slice:
+        """ Row range of the token's bars with unixtimestart <= unixtime <= unixtimeend """
+        start, end = self.index[token_address]
+        unixtime = self.columns['unixtime'][start:end]
+        lo = 0 if unixtimestart is None else int(np.searchsorted(unixtime, unixtimestart, side='left'))
+        hi = len(unixtime) if unixtimeend is None else int(np.searchsorted(unixtime, unixtimeend, side='right'))
+        return slice(start + lo, start + hi)
+
+    def slice(self, token_address, unixtimestart=None, unixtimeend=None) -> dict[str, np.ndarray]:
+        rows = self.rows(token_address, unixtimestart, unixtimeend)
+        return {column: array[rows] for column, array in self.columns.items()}
+
+    def container(self, token_address, unixtimestart=None, unixtimeend=None) -> StreamContainer:
+        """ OHLCV streams over read-only views of the mapped files """
+        data = self.slice(token_address, unixtimestart, unixtimeend)
+        return StreamContainer.from_arrays(pd.Index(data.pop('unixtime')), data)
+
+    def last_unixtime(self, token_address) -> int:
+        """ Unixtime of the token's newest archived bar; later bars only exist in the database """
+        _, end = self.index[token_address]
+        return int(self.columns['unixtime'][end - 1])
+
+    def last(self, token_address, length) -> dict[str, np.ndarray]:
+        start, end = self.index[token_address]
+        return {column: array[max(start, end - length):end] for column, array in self.columns.items()}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("usage: python archive.py <db_path> <archive_root> <interval> [<interval> ...]")
+        sys.exit(1)
+    db_path, root = sys.argv[1], sys.argv[2]
+    for interval in sys.argv[3:]:
+        export_interval(db_path, root, interval)
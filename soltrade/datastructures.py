@@ -1,14 +1,61 @@
+import bisect
+import itertools
 import numpy as np
 import pandas as pd
 from log import log_general
-from sklearn.linear_model import LinearRegression
 from collections import OrderedDict
 
+def rolling_mean_std(data, length):
+    """ Population mean and standard deviation of the `length` values ending at each element (fewer at the start), along the last axis in O(n) """
+    data = np.asarray(data, dtype=float)
+    n = data.shape[-1]
+    n_blocks = -(-n // length)
+    padded = np.concatenate([data, np.repeat(data[..., -1:], n_blocks * length - n, axis=-1)], axis=-1) if n else data
+    blocks = padded.reshape(data.shape[:-1] + (n_blocks, length))
+
+    # running sums are taken relative to each block's first value and restarted per block, which keeps them small
+    refs = blocks[..., :1]
+    deviations = blocks - refs
+    sums, squares = np.cumsum(deviations, axis=-1), np.cumsum(deviations ** 2, axis=-1)
+
+    # a window ending at offset k of block b also covers offsets k+1.. of block b-1, shifted onto block b's reference
+    offsets = np.arange(length)
+    tail_counts = np.broadcast_to(length - 1 - offsets, blocks.shape).copy()
+    tail_counts[..., 0, :] = 0
+    tail_sums, tail_squares = np.zeros_like(blocks), np.zeros_like(blocks)
+    tail_sums[..., 1:, :] = sums[..., :-1, -1:] - sums[..., :-1, :]
+    tail_squares[..., 1:, :] = squares[..., :-1, -1:] - squares[..., :-1, :]
+    shifts = np.zeros_like(refs)
+    shifts[..., 1:, :] = refs[..., :-1, :] - refs[..., 1:, :]
+    window_sums = sums + tail_sums + tail_counts * shifts
+    window_squares = squares + tail_squares + 2 * shifts * tail_sums + tail_counts * shifts ** 2
+
+    counts = offsets + 1 + tail_counts
+    mean_deviation = window_sums / counts
+    variance = np.maximum(window_squares / counts - mean_deviation ** 2, 0)
+    mean = (refs + mean_deviation).reshape(padded.shape)[..., :n]
+    return mean, np.sqrt(variance).reshape(padded.shape)[..., :n]
+
 class MarketPosition:
     exit_types = ['take_profit', 'stop_loss', 'trailing_take_profit', 'trailing_stop_loss', 'triggered_trailing_take_profit', 'triggered_trailing_stop_loss']
-    __slots__ = ['token_address', 'avg_price', 'current_price', 'position_size', 'dual_pct_adj', 'entries', 'exits'] + exit_types
+    state_fields = ['avg_price', 'current_price', 'last_price', 'highest_price', 'position_size']
+    __slots__ = ['token_address', 'state', 'book', 'dual_pct_adj', 'entries', 'exits'] + exit_types
+
+    # Exit conditions are kept sorted; fixed levels fire a prefix of their list, found by bisection:
+    #   take_profit                     [exit_price, pct_exit]                                          ascending exit_price
+    #   stop_loss                       [exit_price, pct_exit]                                          descending exit_price
+    #   trailing_take_profit            [exit_price, pct_trail, reference, pct_exit]                    ascending pct_trail
+    #   trailing_stop_loss              [exit_price, pct_trail, reference, pct_exit]                    ascending pct_trail
+    #   triggered_trailing_*            [exit_price | None, pct_trail, trigger_price, reference | None, pct_exit]
+    #                                   armed levels first by ascending pct_trail, then unarmed ones by ascending trigger_price
+    # Each trailing level keeps its own reference, set to the price when it is added or armed. A stop loss reference only
+    # rises to new highs since then; a take profit reference moves to the price at each new high or down tick since then.
+    reference_index = {'trailing_take_profit': 2, 'trailing_stop_loss': 2, 'triggered_trailing_take_profit': 3, 'triggered_trailing_stop_loss': 3}
 
     def __init__(self, txid, token_address, entry_price, position_size, unixtime):
+        # scalar state lives in a float row so a PositionContainer can hold every position's state in one array
+        self.state = np.empty(len(self.state_fields))
+        self.book = None
         self.token_address : str = token_address
         self.avg_price : float = entry_price
         self.current_price : float = entry_price
@@ -25,25 +72,38 @@ class MarketPosition:
         self.triggered_trailing_take_profit = []
 
     def update(self, current_price : float):
+        self._sync_from_book()
+        if any(getattr(self, exit_type) for exit_type in self.exit_types[2:]):
+            # the references below move ahead of the book's exit tables
+            self._exits_changed()
         self.last_price = self.current_price
         self.current_price = current_price
         if self.current_price > self.highest_price:
             self.highest_price = self.current_price
+        take_profit_reset = self.current_price == self.highest_price or self.current_price < self.last_price
+        for exit_type in self.exit_types[2:]:
+            self._trail(exit_type, take_profit_reset)
         return self._advise()
 
     def confirm(self, exits : dict) -> float:
+        self._sync_from_book()
         exit_amt = 0
         impacted = {key: 0 for key in self.exit_types}
+        confirmed = []
         # exits is of form exit = {txid : (exit_type, exit_pct, exit_condition_index)}
         for txid, vals in exits.items():
             if vals[0] in self.exit_types:
-                getattr(self, vals[0]).pop(vals[2])
+                confirmed.append((vals[0], vals[2]))
                 exit = (vals[0], vals[1])
                 self.exits[txid] = exit
                 impacted[vals[0]] += vals[1]
                 exit_amt += vals[1]
-                if exit_amt >= 1:
-                    return 0
+        # remove from the back so the indices reported by update() stay valid
+        for exit_type, idx in sorted(confirmed, key=lambda x: x[1], reverse=True):
+            getattr(self, exit_type).pop(idx)
+        self._exits_changed()
+        if exit_amt >= 1:
+            return 0
         self.position_size -= self.position_size * exit_amt
         impacted = {k: v for k, v in impacted.items() if v != 0}
         self._adjust_exit_sizes(impacted)
@@ -58,6 +118,7 @@ class MarketPosition:
             msg = f"{exit_type} is not a valid exit type."
             log_general.warning(msg)
             raise ValueError(msg)
+        self._sync_from_book()
         exit_list = getattr(self, exit_type, [])
         try:
             del exit_list[idx]
@@ -65,12 +126,14 @@ class MarketPosition:
             msg = f"Invalid index {idx}; attempting to remove {exit_type} from {self.token_address} position; no action taken."
             log_general.warning(msg)
             raise IndexError(msg)
+        self._exits_changed()
 
-    def get_exit_condition(self, exit_type: str, idx: int) -> tuple:
+    def get_exit_condition(self, exit_type: str, idx: int) -> list:
         if exit_type not in self.exit_types:
             msg = f"{exit_type} is not a valid exit type."
             log_general.warning(msg)
             raise ValueError(msg)
+        self._sync_from_book()
         exit_list = getattr(self, exit_type, [])
         try:
             return exit_list[idx]
@@ -80,48 +143,56 @@ class MarketPosition:
             raise IndexError(msg)
     
     def add_take_profit(self, tp_pct : float, pct_exit : float = 1):
+        self._sync_from_book()
         exit_price = self.current_price + self.current_price * tp_pct
-        exit_condition = (exit_price, pct_exit)
-        self.take_profit.append(exit_condition)
-        self.take_profit.sort(key=lambda x: x[0], reverse=False)
+        exit_condition = [exit_price, pct_exit]
+        bisect.insort(self.take_profit, exit_condition, key=lambda x: x[0])
+        self._exits_changed()
         log_general.info(f'{self.exit_types[0]} added for token_address: {self.token_address} with current_price = {self.current_price}, exit_price = {exit_price}, and pct_exit = {pct_exit*100}%')
 
     def add_stop_loss(self, sl_pct : float, pct_exit : float = 1):
+        self._sync_from_book()
         exit_price = self.current_price - self.current_price * sl_pct
-        exit_condition = (exit_price, pct_exit)
-        self.stop_loss.append(exit_condition)
-        self.stop_loss.sort(key=lambda x: x[0], reverse=True)
+        exit_condition = [exit_price, pct_exit]
+        bisect.insort(self.stop_loss, exit_condition, key=lambda x: -x[0])
+        self._exits_changed()
         log_general.info(f'{self.exit_types[1]} added for token_address: {self.token_address} with current_price = {self.current_price}, exit_price = {exit_price}, and pct_exit = {pct_exit*100}%')
 
     def add_trailing_take_profit(self, pct_trail : float, pct_exit : float = 1):
-        exit_price = self.current_price + (self.current_price * pct_trail)
-        exit_condition = (exit_price, pct_trail, pct_exit)
-        self.trailing_take_profit.append(exit_condition)
-        self.trailing_take_profit.sort(key=lambda x: x[1])
+        self._sync_from_book()
+        exit_price = self._trailing_exit_price(self.exit_types[2], pct_trail, self.current_price)
+        exit_condition = [exit_price, pct_trail, self.current_price, pct_exit]
+        bisect.insort(self.trailing_take_profit, exit_condition, key=lambda x: x[1])
+        self._exits_changed()
         log_general.info(f'{self.exit_types[2]} added for token_address: {self.token_address} with current_price = {self.current_price}, pct_trail = {pct_trail}, and pct_exit = {pct_exit*100}%')
 
     def add_trailing_stop_loss(self, pct_trail : float, pct_exit : float = 1):
-        exit_price = self.current_price - (self.current_price * pct_trail)
-        exit_condition = (exit_price, pct_trail, pct_exit)
-        self.trailing_stop_loss.append(exit_condition)
-        self.trailing_stop_loss.sort(key=lambda x: x[1], reverse=False)
+        self._sync_from_book()
+        exit_price = self._trailing_exit_price(self.exit_types[3], pct_trail, self.current_price)
+        exit_condition = [exit_price, pct_trail, self.current_price, pct_exit]
+        bisect.insort(self.trailing_stop_loss, exit_condition, key=lambda x: x[1])
+        self._exits_changed()
         log_general.info(f'{self.exit_types[3]} added for token_address: {self.token_address} with current_price = {self.current_price}, pct_trail = {pct_trail}, and pct_exit = {pct_exit*100}%')
 
     def add_triggered_trailing_take_profit(self, profit_target_pct : float, pct_trail : float, pct_exit : float = 1):
+        self._sync_from_book()
         trigger_price = self.current_price + (self.current_price * profit_target_pct)
         exit_price = None
-        exit_condition = (exit_price, pct_trail, trigger_price, pct_exit)
-        self.triggered_trailing_take_profit.append(exit_condition)
-        self.triggered_trailing_take_profit.sort(key=lambda x: (x[0] is None, x[0]))
+        exit_condition = [exit_price, pct_trail, trigger_price, None, pct_exit]
+        exit_list = self.triggered_trailing_take_profit
+        bisect.insort(exit_list, exit_condition, lo=self._armed_count(exit_list), key=lambda x: x[2])
+        self._exits_changed()
         log_general.info(f'{self.exit_types[4]} added for token_address: {self.token_address} with current_price = {self.current_price}, trigger_price = {trigger_price}, pct_trail = {pct_trail}, and pct_exit = {pct_exit*100}%')
 
     def add_triggered_trailing_stop_loss(self, profit_target_pct : float, pct_trail : float, pct_exit : float = 1):
+        self._sync_from_book()
         trigger_price = self.current_price + (self.current_price * profit_target_pct)
         exit_price = None
-        exit_condition = (exit_price, pct_trail, trigger_price, pct_exit)
-        self.triggered_trailing_stop_loss.append(exit_condition)
-        self.triggered_trailing_stop_loss.sort(key=lambda x: (x[0] is None, x[0]))
-        log_general.info(f'{self.exit_types[4]} added for token_address: {self.token_address} with current_price = {self.current_price}, trigger_price = {trigger_price}, pct_trail = {pct_trail}, and pct_exit = {pct_exit*100}%')
+        exit_condition = [exit_price, pct_trail, trigger_price, None, pct_exit]
+        exit_list = self.triggered_trailing_stop_loss
+        bisect.insort(exit_list, exit_condition, lo=self._armed_count(exit_list), key=lambda x: x[2])
+        self._exits_changed()
+        log_general.info(f'{self.exit_types[5]} added for token_address: {self.token_address} with current_price = {self.current_price}, trigger_price = {trigger_price}, pct_trail = {pct_trail}, and pct_exit = {pct_exit*100}%')
 
     def _adjust_exit_sizes(self, impacted : dict):
         for exit_type, pct_exit in impacted.items():
@@ -137,62 +208,99 @@ class MarketPosition:
                 exit_list[i][-1] *= factor
             log_general.info(f'all remaining active {exit_type} exit percentages have been multiplied by a factor of {factor} to readjust for the previous confirmed exit')
 
+    def _trail(self, exit_type: str, take_profit_reset: bool):
+        """ Moves each armed level's reference and exit_price with the current price """
+        price = self.current_price
+        ref_idx = self.reference_index[exit_type]
+        stop_loss = exit_type.endswith('stop_loss')
+        for exit in getattr(self, exit_type):
+            if exit[ref_idx] is None:
+                break
+            if (price > exit[ref_idx]) if stop_loss else take_profit_reset:
+                exit[ref_idx] = price
+                exit[0] = self._trailing_exit_price(exit_type, exit[1], price)
+
     def _advise(self) -> list[tuple] | None:
+        price = self.current_price
+        armed_take_profits = self._armed_count(self.triggered_trailing_take_profit)
+        armed_stop_losses = self._armed_count(self.triggered_trailing_stop_loss)
+
+        # fixed levels fire a prefix of their sorted list; trailing levels each compare against their own exit_price
+        triggered = (
+            range(bisect.bisect_right(self.take_profit, price, key=lambda x: x[0])),
+            range(bisect.bisect_right(self.stop_loss, -price, key=lambda x: -x[0])),
+            [idx for idx, exit in enumerate(self.trailing_take_profit) if price >= exit[0]],
+            [idx for idx, exit in enumerate(self.trailing_stop_loss) if price <= exit[0]],
+            [idx for idx, exit in enumerate(self.triggered_trailing_take_profit[:armed_take_profits]) if price >= exit[0]],
+            [idx for idx, exit in enumerate(self.triggered_trailing_stop_loss[:armed_stop_losses]) if price <= exit[0]],
+        )
+
         exit_list: list[tuple] = []
         exit_pct_sum: float = 0.0
-        if self._active_trailing:
-            self._update_trailing_exits()
-        for exit_type in self.exit_types:
-            exit_list, exit_pct_sum = self._check_exits(exit_type, exit_list, exit_pct_sum)
-            if exit_pct_sum >= 1.0:
-                return exit_list
-        return None
-
-    def _check_exits(self, exit_type: str, exit_list: list[tuple], exit_pct_sum: float) -> tuple[list[tuple], float]:
-        exit_attr = getattr(self, exit_type)
-        for idx, exit in enumerate(exit_attr):
-            if self._is_exit_triggered(exit_type, exit):
-                log_general.info(f'{exit_type} triggered for token_address: {self.token_address} at set_price: {exit[0]} current_price: {self.current_price}')
-                exit_list.append((exit_type, exit[-1], idx))
-            exit_pct_sum += exit[-1]
-            if exit_pct_sum >= 1:
-                return exit_list, exit_pct_sum
-        return exit_list, exit_pct_sum
-
-    def _is_exit_triggered(self, exit_type : str, exit : tuple) -> bool:
-        match exit_type:
-            case 'stop_loss' | 'trailing_stop_loss' | 'triggered_trailing_stop_loss':
-                return self.current_price <= exit[0]
-            case 'take_profit' | 'trailing_take_profit' | 'triggered_trailing_take_profit':
-                return self.current_price >= exit[0]
-        
-    def _update_trailing_exits(self):
-        def update_exit_prices(exit_list: list[tuple], price_adjustment_factor: int, exit_type: str):
-            for idx, exit in enumerate(exit_list):
-                new_exit_price = self.current_price + (self.current_price * price_adjustment_factor * float(exit[1]))
-                exit_list[idx][0] = new_exit_price
-                log_general.info(f'{exit_type} for token_address: {self.token_address} has been updated to exit_price = {new_exit_price}, current_price = {self.current_price}')
-
-        if self.trailing_take_profit and (self.current_price == self.highest_price or self.current_price < self.last_price):
-            update_exit_prices(self.trailing_take_profit, 1, self.exit_types[2])
-        if self.trailing_stop_loss and self.current_price == self.highest_price:
-            update_exit_prices(self.trailing_stop_loss, -1, self.exit_types[3])
-
-        def handle_triggered_exits(exit_list: list[tuple], price_adjustment_factor: int, exit_type: str):
-            for idx, exit in enumerate(exit_list):
-                new_exit_price = self.current_price + (self.current_price * price_adjustment_factor * float(exit[1]))
-                update_needed = (self.current_price == self.highest_price) or (price_adjustment_factor == 1 and self.current_price < self.last_price)
-                if exit[0] is None and self.current_price >= exit[2]:
-                    exit_list[idx][0] = new_exit_price
-                    log_general.info(f'{exit_type} for token_address: {self.token_address} has been triggered at current_price = {self.current_price}, exit_price = {new_exit_price}')
-                elif exit[0] is not None and update_needed:
-                    exit_list[idx][0] = new_exit_price
-                    log_general.info(f'{exit_type} for token_address: {self.token_address} has been updated to exit_price = {new_exit_price}, current_price = {self.current_price}')
-
-        if self.triggered_trailing_take_profit:
-            handle_triggered_exits(self.triggered_trailing_take_profit, 1, self.exit_types[4])
-        if self.triggered_trailing_stop_loss:
-            handle_triggered_exits(self.triggered_trailing_stop_loss, -1, self.exit_types[5])
+        for exit_type, indices in zip(self.exit_types, triggered):
+            exits = getattr(self, exit_type)
+            for idx in indices:
+                exit_list.append(self._triggered(exit_type, idx))
+                exit_pct_sum += exits[idx][-1]
+                if exit_pct_sum >= 1:
+                    return exit_list
+
+        # levels armed on this tick start trailing from the next one
+        self._arm_triggered_exits(self.exit_types[4], armed_take_profits)
+        self._arm_triggered_exits(self.exit_types[5], armed_stop_losses)
+        return exit_list or None
+
+    def _triggered(self, exit_type: str, idx: int) -> tuple:
+        self._sync_from_book()
+        exit = getattr(self, exit_type)[idx]
+        log_general.info(f'{exit_type} triggered for token_address: {self.token_address} at set_price: {exit[0]} current_price: {self.current_price}')
+        return (exit_type, exit[-1], idx)
+
+    def _arm_triggered_exits(self, exit_type: str, armed_count: int):
+        self._sync_from_book()
+        exit_list = getattr(self, exit_type)
+        arming_end = bisect.bisect_right(exit_list, self.current_price, lo=armed_count, key=lambda x: x[2])
+        if arming_end == armed_count:
+            return
+        newly_armed = exit_list[armed_count:arming_end]
+        del exit_list[armed_count:arming_end]
+        for exit in newly_armed:
+            exit[3] = self.current_price
+            exit[0] = self._trailing_exit_price(exit_type, exit[1], self.current_price)
+            bisect.insort(exit_list, exit, hi=self._armed_count(exit_list), key=lambda x: x[1])
+            log_general.info(f'{exit_type} for token_address: {self.token_address} has been triggered at current_price = {self.current_price}, exit_price = {exit[0]}')
+        self._exits_changed()
+
+    def _sync_from_book(self):
+        """ Pulls the trailing references update_all advanced in the book's exit tables back into the exit lists """
+        book = self.book
+        if book is None or self.token_address in book.dirty:
+            return
+        row = book.rows[self.token_address]
+        for exit_type in self.exit_types[2:]:
+            exit_list = getattr(self, exit_type)
+            if not exit_list:
+                continue
+            ref_idx = self.reference_index[exit_type]
+            references = book.exit_tables[exit_type][row, :len(exit_list), book.reference_columns[exit_type]]
+            for exit, reference in zip(exit_list, references.tolist()):
+                if exit[ref_idx] is not None:
+                    exit[ref_idx] = reference
+                    exit[0] = self._trailing_exit_price(exit_type, exit[1], reference)
+
+    @staticmethod
+    def _trailing_exit_price(exit_type: str, pct_trail: float, reference: float) -> float:
+        if exit_type.endswith('stop_loss'):
+            return reference * (1 - float(pct_trail))
+        return reference * (1 + float(pct_trail))
+
+    @staticmethod
+    def _armed_count(exit_list: list) -> int:
+        return bisect.bisect_left(exit_list, True, key=lambda x: x[0] is None)
+
+    def _exits_changed(self):
+        if self.book is not None:
+            self.book.dirty.add(self.token_address)
 
     def _recalculate_position(self):
         total_value = sum(price * size for price, size in self.entries.values())
@@ -200,16 +308,34 @@ class MarketPosition:
         self.avg_price = total_value / total_size
         self.position_size = total_size - sum(size for _, size in self.exits.values())
     
-    @property
-    def _active_trailing(self) -> bool:
-        return self.trailing_take_profit or self.trailing_stop_loss or self.triggered_trailing_take_profit or self.triggered_trailing_stop_loss
-    
-class PositionContainer:
-    __slots__ = ['active_holdings', 'strategy_id']
+def _state_property(idx):
+    def getter(self):
+        return self.state[idx]
+    def setter(self, value):
+        self.state[idx] = value
+    return property(getter, setter)
+
+for _idx, _field in enumerate(MarketPosition.state_fields):
+    setattr(MarketPosition, _field, _state_property(_idx))
 
-    def __init__(self, strategy_id):
+class PositionContainer:
+    # exit tables are (positions, levels, fields) arrays mirroring each position's sorted exit lists, NaN padded:
+    #   take_profit / stop_loss          (exit_price, pct_exit)
+    #   trailing_*                       (pct_trail, reference, pct_exit)
+    #   triggered_trailing_*             (pct_trail, trigger_price, reference | NaN until armed, pct_exit)
+    # update_all advances the reference column in place; positions pull it back into their exit lists before using them
+    exit_table_widths = {'take_profit': 2, 'stop_loss': 2, 'trailing_take_profit': 3, 'trailing_stop_loss': 3, 'triggered_trailing_take_profit': 4, 'triggered_trailing_stop_loss': 4}
+    reference_columns = {'trailing_take_profit': 1, 'trailing_stop_loss': 1, 'triggered_trailing_take_profit': 2, 'triggered_trailing_stop_loss': 2}
+    __slots__ = ['active_holdings', 'strategy_id', 'tokens', 'rows', 'state', 'exit_tables', 'dirty']
+
+    def __init__(self, strategy_id, capacity : int = 16):
         self.active_holdings = OrderedDict()
         self.strategy_id = strategy_id
+        self.tokens : list[str] = []
+        self.rows : dict[str, int] = {}
+        self.state = np.full((capacity, len(MarketPosition.state_fields)), np.nan)
+        self.exit_tables = {exit_type: np.full((capacity, 1, width), np.nan) for exit_type, width in self.exit_table_widths.items()}
+        self.dirty = set()
 
     def add_position(self, *args, **kwargs):
         token_address = args[0] if len(args) > 0 else kwargs.get('token_address')
@@ -221,7 +347,152 @@ class PositionContainer:
         if None in [token_address, txid, entry_price, position_size, unixtime]:
             raise ValueError("All required position parameters must be provided.")
 
-        self.active_holdings[token_address] = MarketPosition(txid, token_address, entry_price, position_size, unixtime)
+        if token_address in self.active_holdings:
+            self.remove_position(token_address)
+        position = MarketPosition(txid, token_address, entry_price, position_size, unixtime)
+        row = len(self.tokens)
+        if row == len(self.state):
+            self._grow_rows(2 * len(self.state))
+        self.state[row] = position.state
+        position.state = self.state[row]
+        position.book = self
+        self.tokens.append(token_address)
+        self.rows[token_address] = row
+        self.active_holdings[token_address] = position
+        self.dirty.add(token_address)
+
+    def remove_position(self, token_address : str) -> MarketPosition:
+        """ Detaches a position from the book, moving the last row into its slot """
+        position = self.active_holdings[token_address]
+        position._sync_from_book()
+        del self.active_holdings[token_address]
+        row, last = self.rows.pop(token_address), len(self.tokens) - 1
+        position.state = position.state.copy()
+        position.book = None
+        if row != last:
+            moved = self.tokens[last]
+            self.state[row] = self.state[last]
+            for table in self.exit_tables.values():
+                table[row] = table[last]
+            self.tokens[row] = moved
+            self.rows[moved] = row
+            self.active_holdings[moved].state = self.state[row]
+        self.tokens.pop()
+        self.state[last] = np.nan
+        for table in self.exit_tables.values():
+            table[last] = np.nan
+        self.dirty.discard(token_address)
+        return position
+
+    def update_all(self, prices) -> dict[str, list[tuple]]:
+        """ Updates every position with prices aligned to self.tokens (NaN skips a position) and returns the triggered exits by token """
+        n = len(self.tokens)
+        prices = np.asarray(prices, dtype=float)
+        if prices.shape != (n,):
+            raise ValueError(f"Expected {n} prices aligned to the position book, got shape {prices.shape}")
+        self._compile_exit_tables()
+        fields = MarketPosition.state_fields
+        state = self.state[:n]
+        last, highest = (state[:, fields.index(field)] for field in ('last_price', 'highest_price'))
+        priced = ~np.isnan(prices)
+        current = np.where(priced, prices, state[:, fields.index('current_price')])
+
+        # same bookkeeping as MarketPosition.update
+        last[priced] = state[priced, fields.index('current_price')]
+        state[:, fields.index('current_price')] = current
+        np.fmax(highest, current, out=highest)
+        take_profit_reset = (priced & ((current == highest) | (current < last)))[:, None]
+
+        tables = {exit_type: table[:n] for exit_type, table in self.exit_tables.items()}
+        price = current[:, None]
+        # per-level references advance in place, as MarketPosition._trail does for each armed level
+        exit_prices = {}
+        for exit_type in MarketPosition.exit_types[2:]:
+            table = tables[exit_type]
+            reference = table[..., self.reference_columns[exit_type]]
+            stop_loss = exit_type.endswith('stop_loss')
+            moved = (priced[:, None] & (price > reference)) if stop_loss else (take_profit_reset & ~np.isnan(reference))
+            reference[moved] = np.broadcast_to(price, reference.shape)[moved]
+            exit_prices[exit_type] = reference * (1 - table[..., 0]) if stop_loss else reference * (1 + table[..., 0])
+
+        fired = [
+            price >= tables['take_profit'][..., 0],
+            price <= tables['stop_loss'][..., 0],
+            price >= exit_prices['trailing_take_profit'],
+            price <= exit_prices['trailing_stop_loss'],
+            price >= exit_prices['triggered_trailing_take_profit'],
+            price <= exit_prices['triggered_trailing_stop_loss'],
+        ]
+        fired = np.concatenate(fired, axis=1) & priced[:, None]
+        pcts = np.concatenate([tables[exit_type][..., -1] for exit_type in MarketPosition.exit_types], axis=1)
+
+        # exits are taken in exit_types order until their percentages reach the full position
+        contrib = np.where(fired, pcts, 0)
+        taken = fired & (np.cumsum(contrib, axis=1) - contrib < 1)
+        closed = np.where(taken, pcts, 0).sum(axis=1) >= 1
+        arming = np.zeros(n, dtype=bool)
+        for exit_type in MarketPosition.exit_types[4:]:
+            table = tables[exit_type]
+            arming |= (np.isnan(table[..., self.reference_columns[exit_type]]) & (price >= table[..., 1])).any(axis=1)
+        arming &= priced & ~closed
+
+        triggered = {}
+        offsets = np.cumsum([0] + [tables[exit_type].shape[1] for exit_type in MarketPosition.exit_types])
+        for row in np.flatnonzero(taken.any(axis=1) | arming):
+            position = self.active_holdings[self.tokens[row]]
+            exits = []
+            for col in np.flatnonzero(taken[row]):
+                type_idx = np.searchsorted(offsets, col, side='right') - 1
+                exits.append(position._triggered(MarketPosition.exit_types[type_idx], int(col - offsets[type_idx])))
+            if exits:
+                triggered[position.token_address] = exits
+            if arming[row]:
+                for exit_type in MarketPosition.exit_types[4:]:
+                    position._arm_triggered_exits(exit_type, position._armed_count(getattr(position, exit_type)))
+        return triggered
+
+    def _compile_exit_tables(self):
+        for token_address in self.dirty:
+            row = self.rows[token_address]
+            position = self.active_holdings[token_address]
+            for exit_type in MarketPosition.exit_types:
+                exit_list = getattr(position, exit_type)
+                table = self.exit_tables[exit_type]
+                if len(exit_list) > table.shape[1]:
+                    table = self._grow_levels(exit_type, max(len(exit_list), 2 * table.shape[1]))
+                table[row] = np.nan
+                if exit_list:
+                    table[row, :len(exit_list)] = [self._exit_table_row(exit_type, exit) for exit in exit_list]
+        self.dirty.clear()
+
+    @staticmethod
+    def _exit_table_row(exit_type : str, exit : list) -> tuple:
+        match exit_type:
+            case 'take_profit' | 'stop_loss':
+                return (exit[0], exit[1])
+            case 'trailing_take_profit' | 'trailing_stop_loss':
+                return (exit[1], exit[2], exit[3])
+            case 'triggered_trailing_take_profit' | 'triggered_trailing_stop_loss':
+                return (exit[1], exit[2], np.nan if exit[3] is None else exit[3], exit[4])
+
+    def _grow_rows(self, capacity : int):
+        n = len(self.tokens)
+        state = np.full((capacity, self.state.shape[1]), np.nan)
+        state[:n] = self.state[:n]
+        self.state = state
+        for row, token_address in enumerate(self.tokens):
+            self.active_holdings[token_address].state = state[row]
+        for exit_type, table in self.exit_tables.items():
+            grown = np.full((capacity,) + table.shape[1:], np.nan)
+            grown[:n] = table[:n]
+            self.exit_tables[exit_type] = grown
+
+    def _grow_levels(self, exit_type : str, levels : int) -> np.ndarray:
+        table = self.exit_tables[exit_type]
+        grown = np.full((table.shape[0], levels, table.shape[2]), np.nan)
+        grown[:, :table.shape[1]] = table
+        self.exit_tables[exit_type] = grown
+        return grown
     
     def __getattr__(self, token : str) -> MarketPosition:
         if token in self.active_holdings:
@@ -236,10 +507,14 @@ class PositionContainer:
         return f"<StreamContainer with streams: {list(self.active_holdings.keys())}>"
 
 class Stream:
-    __slots__ = ['data']
+    __slots__ = ['data', '_cache', '_version', '_serial']
+    _serials = itertools.count()  # unlike id(), never reused once a stream is garbage collected
 
     def __init__(self, data):
         self.data : np.array = self.arrange(data)
+        self._cache : dict = {}
+        self._version : int = 0
+        self._serial : int = next(Stream._serials)
 
     def __iter__(self):
         return iter(self.data)
@@ -250,8 +525,10 @@ class Stream:
     def arrange(self, data):
         if isinstance(data, pd.Series):
             return data.values
+        elif isinstance(data, np.ndarray):
+            return data
         else:
-            raise ValueError("Input must be a pandas Series")
+            raise ValueError("Input must be a pandas Series or numpy array")
         
     def mean(self, length=1, lag=0) -> float:
         if lag + length > len(self.data):
@@ -306,16 +583,101 @@ class Stream:
         return False
     
     def has_crossed_above(self, other, lookback=0) -> bool:
-        for lag in range(lookback + 1):
-            if self.crossed_above(other, lag):
-                return True
-        return False
+        crossings = self.crossed_above_series(other)
+        return bool(crossings[max(0, len(crossings) - 1 - lookback):].any())
 
     def has_crossed_below(self, other, lookback=0) -> bool:
-        for lag in range(lookback + 1):
-            if self.crossed_below(other, lag):
-                return True
-        return False
+        crossings = self.crossed_below_series(other)
+        return bool(crossings[max(0, len(crossings) - 1 - lookback):].any())
+
+    # Whole-series versions of the point queries; each result is computed once and cached until clear_cache().
+    # rolling_*(length, lag)[i] equals the point query on the stream cut off at bar i, and is NaN where that window is empty
+
+    def clear_cache(self):
+        """ Must be called after writing into data in place """
+        self._cache.clear()
+        self._version += 1
+
+    def crossed_above_series(self, other) -> np.ndarray:
+        return self._cached(('crossed_above', self._cache_token(other)), lambda: self._crossings(other, above=True))
+
+    def crossed_below_series(self, other) -> np.ndarray:
+        return self._cached(('crossed_below', self._cache_token(other)), lambda: self._crossings(other, above=False))
+
+    def crossover_indices(self, other) -> np.ndarray:
+        return self._cached(('crossover_indices', self._cache_token(other)), lambda: np.flatnonzero(self.crossed_above_series(other)))
+
+    def crossunder_indices(self, other) -> np.ndarray:
+        return self._cached(('crossunder_indices', self._cache_token(other)), lambda: np.flatnonzero(self.crossed_below_series(other)))
+
+    def above_series(self, other) -> np.ndarray:
+        return self._cached(('above', self._cache_token(other)), lambda: np.greater(*self._aligned(other)))
+
+    def below_series(self, other) -> np.ndarray:
+        return self._cached(('below', self._cache_token(other)), lambda: np.less(*self._aligned(other)))
+
+    def rolling_mean(self, length=1, lag=0) -> np.ndarray:
+        return self._rolling_mean_std(length, lag)[0]
+
+    def rolling_std(self, length=1, lag=0) -> np.ndarray:
+        return self._rolling_mean_std(length, lag)[1]
+
+    def rolling_max(self, length=1, lag=0) -> np.ndarray:
+        return self._cached(('rolling_max', length, lag), lambda: self._rolling_extreme(length, lag, np.max))
+
+    def rolling_min(self, length=1, lag=0) -> np.ndarray:
+        return self._cached(('rolling_min', length, lag), lambda: self._rolling_extreme(length, lag, np.min))
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def _cache_token(self, other):
+        return (other._serial, other._version) if isinstance(other, Stream) else other
+
+    def _aligned(self, other) -> tuple[np.ndarray, np.ndarray]:
+        # streams of different lengths are compared on their most recent values, as in the point queries
+        if isinstance(other, Stream):
+            length = min(len(self.data), len(other.data))
+            return self.data[len(self.data) - length:], other.data[len(other.data) - length:]
+        return self.data, np.full(len(self.data), other)
+
+    def _crossings(self, other, above: bool) -> np.ndarray:
+        current, reference = self._aligned(other)
+        crossings = np.zeros(len(current), dtype=bool)
+        if above:
+            crossings[1:] = (current[1:] > reference[1:]) & (current[:-1] <= reference[:-1])
+        else:
+            crossings[1:] = (current[1:] < reference[1:]) & (current[:-1] >= reference[:-1])
+        return crossings
+
+    @staticmethod
+    def _point_window(length, lag) -> tuple[int, int]:
+        # the point queries read the length + 1 values ending at the last bar, or with a lag, the length values ending lag + 1 bars back
+        return (length + 1, 0) if lag == 0 else (length, lag + 1)
+
+    @staticmethod
+    def _shift(series, offset) -> np.ndarray:
+        if offset == 0:
+            return series
+        out = np.full(len(series), np.nan)
+        out[offset:] = series[:max(0, len(series) - offset)]
+        return out
+
+    def _rolling_mean_std(self, length, lag) -> tuple[np.ndarray, np.ndarray]:
+        # windows are shorter at the start of the stream, as the point queries clamp their length
+        def compute():
+            window, offset = self._point_window(length, lag)
+            mean, std = rolling_mean_std(self.data, window)
+            return self._shift(mean, offset), self._shift(std, offset)
+        return self._cached(('rolling_mean_std', length, lag), compute)
+
+    def _rolling_extreme(self, length, lag, reducer) -> np.ndarray:
+        window, offset = self._point_window(length, lag)
+        data = self.data.astype(float)
+        padded = np.concatenate([np.repeat(data[:1], window - 1), data])
+        return self._shift(reducer(np.lib.stride_tricks.sliding_window_view(padded, window), axis=-1), offset)
     
     def is_above(self, value, lag=0) -> bool:
         return self.data[-1 - lag] > value if lag < len(self.data) else False
@@ -324,10 +686,12 @@ class Stream:
         return self.data[-1 - lag] < value if lag < len(self.data) else False
 
     def is_rising(self, length=1, lag=0) -> bool:
-        return self.slope(lag, length) > 0
+        slope = self.slope(length, lag)
+        return slope is not None and slope > 0
 
     def is_falling(self, length=1, lag=0) -> bool:
-        return self.slope(lag, length) < 0
+        slope = self.slope(length, lag)
+        return slope is not None and slope < 0
     
     def average_gain(self, length=1, lag=0):
         if lag + length > len(self.data):
@@ -355,35 +719,86 @@ class Stream:
         losses = np.where(percentage_changes < 0, -percentage_changes, 0)
         return np.mean(losses) if len(losses) > 0 else 0 
     
-    def slope(self, length=1, lag=0) -> float:
-        if lag + length >= len(self.data):
-            return None
-        x = np.arange(length + 1).reshape(-1, 1)
-        y = self.data[-1 - lag - length: -1 - lag if lag > 0 else None].reshape(-1, 1)
-        model = LinearRegression()
-        model.fit(x, y)
-        return float(model.coef_[0][0]) if model else 0.0
+    def slope(self, length=1, lag=0) -> float | None:
+        fit = self._fit_line(length, lag)
+        return fit[0] if fit else None
 
     def predict(self, future_steps=1, length=1, lag=0) -> float | None:
-        model = self._fit_model(lag, length)
-        if model:
-            highest_x = length 
-            predicted_x = np.array([[highest_x + future_steps]])
-            predicted_y = model.predict(predicted_x)
-            return float(predicted_y[0][0])
+        fit = self._fit_line(length, lag)
+        if fit:
+            slope, intercept = fit
+            return slope * (length + future_steps) + intercept
         return None
 
-    def _fit_model(self, length=1, lag=0):
-        if lag + length >= len(self.data):
+    def rolling_slope(self, length=1) -> np.ndarray:
+        """ Least-squares slope over the length + 1 values ending at each element; NaN where the window is incomplete """
+        out = np.full(len(self.data), np.nan)
+        if length < 1 or length >= len(self.data):
+            return out
+        out[length:] = np.correlate(self.data.astype(float), self._regression_weights(length), mode='valid')
+        return out
+
+    def _fit_line(self, length=1, lag=0) -> tuple[float, float] | None:
+        # closed-form least squares of the last length + 1 values (ending lag bars back) against x = 0..length
+        if length < 1 or lag + length >= len(self.data):
             return None
-        x = np.arange(length + 1).reshape(-1, 1)
-        y = self.data[-1 - lag - length: -1 - lag if lag > 0 else None].reshape(-1, 1)
-        model = LinearRegression()
-        model.fit(x, y)
-        return model
+        y = self.data[len(self.data) - 1 - lag - length: len(self.data) - lag].astype(float)
+        slope = float(np.dot(self._regression_weights(length), y))
+        intercept = float(np.mean(y)) - slope * length / 2
+        return slope, intercept
+
+    @staticmethod
+    def _regression_weights(length) -> np.ndarray:
+        x = np.arange(length + 1) - length / 2
+        return x / np.dot(x, x)
+
+class RingStream(Stream):
+    """ Fixed-capacity, append-only stream; data is always a contiguous, writable view of the most recent values """
+    __slots__ = ['capacity', '_buffer', '_start', '_end']
+
+    def __init__(self, capacity, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError("RingStream capacity must be at least 1")
+        # twice the capacity so the live window only has to be moved back to the front once every `capacity` appends
+        self.capacity : int = capacity
+        self._buffer : np.ndarray = np.full(2 * capacity, np.nan if np.issubdtype(dtype, np.floating) else 0, dtype=dtype)
+        self._start : int = 0
+        self._end : int = 0
+        self._cache : dict = {}
+        self._version : int = 0
+        self._serial : int = next(Stream._serials)
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._buffer[self._start:self._end]
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, value):
+        if self._end == len(self._buffer):
+            keep = self.capacity - 1
+            self._buffer[:keep] = self._buffer[self._end - keep:self._end]
+            self._start, self._end = 0, keep
+        self._buffer[self._end] = value
+        self._end += 1
+        if self._end - self._start > self.capacity:
+            self._start += 1
+        self.clear_cache()
+
+    def extend(self, values):
+        values = np.asarray(values)[-self.capacity:]
+        if self._end + len(values) > len(self._buffer):
+            keep = min(self._end - self._start, self.capacity - len(values))
+            self._buffer[:keep] = self._buffer[self._end - keep:self._end]
+            self._start, self._end = 0, keep
+        self._buffer[self._end:self._end + len(values)] = values
+        self._end += len(values)
+        self._start = max(self._start, self._end - self.capacity)
+        self.clear_cache()
 
 class StreamContainer:
-    __slots__ = ['unixtime', 'streams']
+    __slots__ = ['unixtime', 'streams', 'block']
     
     def __init__(self, data, alias_list=None):
         if not isinstance(data, pd.DataFrame):
@@ -391,6 +806,7 @@ class StreamContainer:
 
         self.unixtime = data.index
         self.streams = {}
+        self.block = None
 
         if alias_list is None:
             alias_list = data.columns
@@ -401,6 +817,42 @@ class StreamContainer:
         for alias, column in zip(alias_list, data.columns):
             self.streams[alias] = Stream(data[column])
 
+    @classmethod
+    def from_arrays(cls, unixtime, arrays: dict):
+        """ Builds a container around existing arrays without copying; 2D arrays are panels of shape (tokens, bars) """
+        instance = cls.__new__(cls)
+        instance.unixtime = unixtime
+        instance.streams = {alias: Stream(array) for alias, array in arrays.items()}
+        instance.block = None
+        return instance
+
+    @classmethod
+    def from_block(cls, unixtime, block: np.ndarray, alias_list):
+        """ Wraps one contiguous (bars, columns) array; every stream is a zero-copy view of its column """
+        if block.ndim != 2 or block.shape[1] != len(alias_list):
+            raise ValueError("Block must be two dimensional with one column per alias")
+        instance = cls.from_arrays(unixtime, {alias: block[:, column] for column, alias in enumerate(alias_list)})
+        instance.block = block
+        return instance
+
+    @classmethod
+    def from_rows(cls, rows, alias_list, dtype=np.float64):
+        """ Builds a block container straight from database rows of the form (unixtime, value_1, ..., value_n); NULLs become NaN """
+        if not rows:
+            return cls.from_block(pd.Index(np.empty(0, dtype=np.int64)), np.empty((0, len(alias_list)), dtype=dtype), alias_list)
+        values = np.array(rows, dtype=np.float64)
+        unixtime = pd.Index(values[:, 0].astype(np.int64))
+        block = np.ascontiguousarray(values[:, 1:], dtype=dtype)
+        return cls.from_block(unixtime, block, alias_list)
+
+    def row(self, idx: int):
+        """ Per-token view into a panel container; writes go through to the panel """
+        return StreamContainer.from_arrays(self.unixtime, {alias: stream.data[idx] for alias, stream in self.streams.items()})
+
+    def take(self, idxs):
+        """ Copy of the given panel rows """
+        return StreamContainer.from_arrays(self.unixtime, {alias: stream.data[idxs] for alias, stream in self.streams.items()})
+
     def __getattr__(self, name):
         if name in self.streams:
             return self.streams[name]
@@ -412,3 +864,37 @@ class StreamContainer:
 
     def __repr__(self):
         return f"<StreamContainer with streams: {list(self.streams.keys())}>"
+
+
+class RingStreamContainer(StreamContainer):
+    """ StreamContainer of RingStreams sharing one unixtime ring, for keeping live streams resident between runs """
+    __slots__ = ['capacity', '_unixtime']
+
+    def __init__(self, alias_list, capacity, dtype=np.float64):
+        self.capacity : int = capacity
+        self._unixtime : RingStream = RingStream(capacity, dtype=np.int64)
+        self.streams = {alias: RingStream(capacity, dtype) for alias in alias_list}
+        self.block = None
+
+    @property
+    def unixtime(self) -> np.ndarray:
+        return self._unixtime.data
+
+    @property
+    def last_unixtime(self) -> int | None:
+        return int(self._unixtime.data[-1]) if len(self._unixtime) else None
+
+    def append(self, unixtime, values):
+        self._unixtime.append(unixtime)
+        for stream, value in zip(self.streams.values(), values):
+            stream.append(value)
+
+    def extend(self, unixtimes, rows):
+        """ rows holds one column per stream, in alias order """
+        rows = np.asarray(rows, dtype=float).reshape(len(unixtimes), len(self.streams))
+        self._unixtime.extend(unixtimes)
+        for column, stream in enumerate(self.streams.values()):
+            stream.extend(rows[:, column])
+
+    def __repr__(self):
+        return f"<RingStreamContainer with streams: {list(self.streams.keys())}, capacity: {self.capacity}>"
\ No newline at end of file
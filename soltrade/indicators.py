@@ -1,15 +1,49 @@
+import re
 import numpy as np
 import pandas as pd
-from datastructures import Stream, StreamContainer
+from datastructures import Stream, StreamContainer, rolling_mean_std
 from abc import ABC, abstractmethod
 from log import log_general
 
+_MIN_DECAY_POWER = 1e-150
+
+def indicator_table_name(indicator_id, interval) -> str:
+    """ Narrow storage table holding one indicator's columns for one interval, keyed on (token_address, unixtime) """
+    return re.sub(r'\W', '_', f"indicator_{interval}_{indicator_id}")
+
+def _linear_recurrence(x, decay, seed):
+    """ Evaluates y[i] = decay * y[i-1] + x[i] along the last axis with y[-1] = seed, in blocks short enough that decay**-k stays finite """
+    x = np.asarray(x, dtype=float)
+    if decay == 0:
+        return x.copy()
+    out = np.empty_like(x)
+    block = max(1, int(np.log(_MIN_DECAY_POWER) / np.log(decay)))
+    prev = np.asarray(seed, dtype=float)
+    for start in range(0, x.shape[-1], block):
+        segment = x[..., start:start + block]
+        powers = decay ** np.arange(1, segment.shape[-1] + 1)
+        out[..., start:start + block] = powers * (prev[..., None] + np.cumsum(segment / powers, axis=-1))
+        prev = out[..., start + segment.shape[-1] - 1]
+    return out
+
+class IndicatorState:
+    __slots__ = ['unixtime', 'values', 'memory']
+
+    def __init__(self, unixtime, values, memory=None):
+        self.unixtime : int = unixtime
+        self.values : tuple = values
+        self.memory : dict = memory or {}
+
+    def __repr__(self):
+        return f"<IndicatorState at unixtime: {self.unixtime} with values: {self.values}>"
+
 class Indicator(ABC):
     input_arguments: int = 1
     output_streams: int = 1
     n_self_referential: int = 1
     category: str = None  # 'price_bound', 'zero_mean', 'non_zero_mean_bounded', 'non_zero_mean_unbounded'
     bounds: tuple = None  # (min_value, max_value)
+    state_keys: tuple = ()  # attributes carrying recursive terms that are not part of the output streams
 
     def __init__(self, *args):
         if len(args) != self.input_arguments:
@@ -25,37 +59,150 @@ class Indicator(ABC):
         assert len(self.stream_aliases) == len(set(self.stream_aliases)), "Stream aliases must be unique"
         self.alias_to_cols = dict(zip(self.stream_aliases, self.cols))
 
-    def next(self, ohclv: StreamContainer, prevs: StreamContainer):
+    def next(self, ohclv: StreamContainer, prevs: StreamContainer, state: 'IndicatorState' = None):
         data_length = len(next(iter(prevs.streams.values())).data)
-        first_valid_idx = self.n_self_referential
-        all_nan_init = False 
         self.prevs = prevs
+        if data_length == 0:
+            return prevs, (0, -1), state
 
-        for stream in prevs.streams.values():
-            if np.isnan(stream.data[:first_valid_idx]).all():
-                all_nan_init = True
-                default_value = self.determine_default_value(ohclv, stream)
-                stream.data[:first_valid_idx] = default_value
+        if state is None:
+            state = self.restore_state(ohclv, prevs)
+        resume_idx = self.resume_index(ohclv, state)
+
+        if resume_idx is not None:
+            for alias, value in zip(self.stream_aliases, state.values):
+                prevs.streams[alias].data[resume_idx - 1] = value
+            for key, value in state.memory.items():
+                setattr(self, key, value)
+            start_idx = first_valid_idx = resume_idx
+        else:
+            self.reset_state()
+            first_valid_idx = self.n_self_referential
+            all_nan_init = False
+            for stream in prevs.streams.values():
+                if np.isnan(stream.data[:first_valid_idx]).all():
+                    all_nan_init = True
+                    default_value = self.determine_default_value(ohclv, stream)
+                    stream.data[:first_valid_idx] = default_value
+            start_idx = 0 if all_nan_init else first_valid_idx
+
+        if first_valid_idx < data_length:
+            self.compute(ohclv, prevs, first_valid_idx)
 
-        start_idx = 0 if all_nan_init else first_valid_idx
+        return prevs, (start_idx, data_length - 1), self.capture_state(ohclv, prevs, data_length - 1)
 
-        for idx in range(first_valid_idx, data_length):
+    def next_panel(self, ohclv: StreamContainer, prevs: StreamContainer, states: list) -> tuple[list, list]:
+        """ Evaluates the indicator once across a (tokens x bars) panel sharing one unixtime index; returns per-row new index ranges and states """
+        n_rows, data_length = ohclv.close.data.shape
+        if not self.has_batch or data_length == 0:
+            results = [self.next(ohclv.row(row), prevs.row(row), states[row]) for row in range(n_rows)]
+            return [result[1] for result in results], [result[2] for result in results]
+
+        states = [state if state is not None else self.restore_state(ohclv, prevs.row(row)) for row, state in enumerate(states)]
+        groups = {}
+        for row, state in enumerate(states):
+            groups.setdefault(self.resume_index(ohclv, state), []).append(row)
+
+        new_idxs, new_states = [None] * n_rows, [None] * n_rows
+        for resume_idx, rows in groups.items():
+            whole_panel = len(rows) == n_rows
+            group_ohclv = ohclv if whole_panel else ohclv.take(rows)
+            group_prevs = prevs if whole_panel else prevs.take(rows)
+            self.prevs = group_prevs
+
+            if resume_idx is not None:
+                for position, alias in enumerate(self.stream_aliases):
+                    group_prevs.streams[alias].data[:, resume_idx - 1] = [states[row].values[position] for row in rows]
+                for key in self.state_keys:
+                    setattr(self, key, np.array([states[row].memory[key] for row in rows], dtype=float))
+                first_valid_idx = resume_idx
+                start_idxs = np.full(len(rows), resume_idx)
+            else:
+                self.reset_state()
+                first_valid_idx = self.n_self_referential
+                all_nan_init = np.zeros(len(rows), dtype=bool)
+                for stream in group_prevs.streams.values():
+                    head = stream.data[:, :first_valid_idx]
+                    uninitialised = np.isnan(head).all(axis=-1)
+                    if uninitialised.any():
+                        default_value = np.broadcast_to(self.determine_default_value(group_ohclv, stream), (len(rows),))
+                        head[uninitialised] = default_value[uninitialised, None]
+                    all_nan_init |= uninitialised
+                start_idxs = np.where(all_nan_init, 0, first_valid_idx)
+
+            if first_valid_idx < data_length:
+                self.compute(group_ohclv, group_prevs, first_valid_idx)
+            if not whole_panel:
+                for alias, stream in group_prevs.streams.items():
+                    prevs.streams[alias].data[rows] = stream.data
+
+            memory = {key: np.broadcast_to(getattr(self, key), (len(rows),)) for key in self.state_keys}
+            for position, row in enumerate(rows):
+                values = tuple(prevs.streams[alias].data[row, -1] for alias in self.stream_aliases)
+                new_states[row] = IndicatorState(ohclv.unixtime[-1], values, {key: float(value[position]) for key, value in memory.items()})
+                new_idxs[row] = (int(start_idxs[position]), data_length - 1)
+
+        return new_idxs, new_states
+
+    def compute(self, ohclv: StreamContainer, prevs: StreamContainer, first_valid_idx: int):
+        if self.has_batch:
             try:
-                calculated_values = self.calculate(ohclv, idx)
-                for alias, value in zip(self.stream_aliases, calculated_values):
+                calculated_series = self.calculate_batch(ohclv, first_valid_idx)
+                for alias, values in zip(self.stream_aliases, calculated_series):
                     if self.bounds:
-                        value = max(min(value, self.bounds[1]), self.bounds[0])
-                    prevs.streams[alias].data[idx] = value
+                        values = np.clip(values, self.bounds[0], self.bounds[1])
+                    prevs.streams[alias].data[..., first_valid_idx:] = values
             except Exception as e:
-                self.handle_calculation_error(e, idx)
+                self.handle_calculation_error(e, first_valid_idx)
+        else:
+            for idx in range(first_valid_idx, len(ohclv.close.data)):
+                try:
+                    calculated_values = self.calculate(ohclv, idx)
+                    for alias, value in zip(self.stream_aliases, calculated_values):
+                        if self.bounds:
+                            value = max(min(value, self.bounds[1]), self.bounds[0])
+                        prevs.streams[alias].data[idx] = value
+                except Exception as e:
+                    self.handle_calculation_error(e, idx)
+
+        for stream in prevs.streams.values():
+            stream.clear_cache()
 
-        return prevs, (start_idx, data_length - 1)
+    def resume_index(self, ohclv: StreamContainer, state: 'IndicatorState') -> int | None:
+        if state is None:
+            return None
+        unixtime = np.asarray(ohclv.unixtime)
+        position = np.searchsorted(unixtime, state.unixtime)
+        if position >= len(unixtime) or unixtime[position] != state.unixtime or position + 1 < self.n_self_referential:
+            return None
+        return int(position) + 1
+
+    def restore_state(self, ohclv: StreamContainer, prevs: StreamContainer) -> 'IndicatorState':
+        # only indicators whose recursion is fully described by their stored outputs can resume from database rows
+        if self.state_keys:
+            return None
+        stored = np.ones(len(ohclv.unixtime), dtype=bool)
+        for stream in prevs.streams.values():
+            stored &= ~np.isnan(stream.data.astype(float))
+        stored_idxs = np.flatnonzero(stored)
+        if len(stored_idxs) == 0 or stored_idxs[-1] + 1 < self.n_self_referential:
+            return None
+        return self.capture_state(ohclv, prevs, stored_idxs[-1])
+
+    def reset_state(self):
+        """ Returns the state_keys attributes to their values before any bar has been absorbed """
+        pass
+
+    def capture_state(self, ohclv: StreamContainer, prevs: StreamContainer, idx: int) -> 'IndicatorState':
+        values = tuple(prevs.streams[alias].data[idx] for alias in self.stream_aliases)
+        memory = {key: getattr(self, key) for key in self.state_keys}
+        return IndicatorState(ohclv.unixtime[idx], values, memory)
 
     def determine_default_value(self, ohclv, stream):
         if self.category in [None, 'zero_mean', 'non_zero_mean_unbounded']:
             return 0
         elif self.category == 'price_bound':
-            return ohclv.close[0]
+            return ohclv.close.data[..., 0]
         elif self.category == 'non_zero_mean_bounded':
             if not self.bounds:
                 raise ValueError("Bounds must be set for non_zero_mean_bounded category")
@@ -72,10 +219,21 @@ class Indicator(ABC):
         """ Implement the calculation logic for the indicator in subclasses """
         pass
 
+    def calculate_batch(self, ohclv, start_idx):
+        """ Optionally implement a whole-array calculation in subclasses; must return one array per output stream covering bars start_idx onward """
+        raise NotImplementedError
+
+    @property
+    def has_batch(self) -> bool:
+        return type(self).calculate_batch is not Indicator.calculate_batch
+
     def indicator_id(self) -> str:
         base_name = self.__class__.__name__.upper()
         return f"{base_name}_{'_'.join(map(str, self.args))}"
 
+    def table_name(self, interval) -> str:
+        return indicator_table_name(self.id, interval)
+
     def column_names(self) -> tuple:
         return tuple(f"{self.id}_STREAM_{i+1}" for i in range(self.output_streams))
 
@@ -93,6 +251,12 @@ class EMA(Indicator):
         out = ohclv.close[idx] * multiplier + self.prevs.out[idx-1] * (1-multiplier)
         return (out,)
 
+    def calculate_batch(self, ohclv, start_idx):
+        multiplier = 2 / (self.length + 1)
+        close = ohclv.close.data[..., start_idx:]
+        seed = self.prevs.out.data[..., start_idx-1]
+        return (_linear_recurrence(close * multiplier, 1 - multiplier, seed),)
+
 class ATR(Indicator):
     category = 'non_zero_mean_unbounded'
     
@@ -104,6 +268,14 @@ class ATR(Indicator):
         out = (self.prevs.out[idx-1] * (self.length - 1) + tr) / self.length
         return (out,)
 
+    def calculate_batch(self, ohclv, start_idx):
+        high = ohclv.high.data[..., start_idx:]
+        low = ohclv.low.data[..., start_idx:]
+        prev_close = ohclv.close.data[..., start_idx-1:-1]
+        tr = np.maximum(high - low, np.maximum(np.abs(high - prev_close), np.abs(low - prev_close)))
+        seed = self.prevs.out.data[..., start_idx-1]
+        return (_linear_recurrence(tr / self.length, (self.length - 1) / self.length, seed),)
+
 class BOLLINGER(Indicator):
     input_arguments = 2
     output_streams = 3
@@ -116,28 +288,70 @@ class BOLLINGER(Indicator):
         self.ema_indicator = EMA(self.length)
     
     def calculate(self, ohclv, idx):
-        lag = len(ohclv.close.data) - 1 - idx
-        middle = ohclv.close.mean(length=self.length, lag=lag)
-        std = ohclv.close.std_dev(length=self.length, lag=lag)
+        window = ohclv.close.data[max(0, idx + 1 - self.length):idx + 1]
+        middle = np.mean(window)
+        std = np.std(window)
         upper = middle + std * self.std_devs
         lower = middle - std * self.std_devs
         return (upper, middle, lower)
+
+    def calculate_batch(self, ohclv, start_idx):
+        window_start = max(0, start_idx + 1 - self.length)
+        middle, std = rolling_mean_std(ohclv.close.data[..., window_start:], self.length)
+        middle, std = middle[..., start_idx - window_start:], std[..., start_idx - window_start:]
+        return (middle + std * self.std_devs, middle, middle - std * self.std_devs)
     
 class RSI(Indicator):
     category = 'non_zero_mean_bounded'
     bounds = (0, 100)
+    state_keys = ('avg_gain', 'avg_loss', 'changes')
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reset_state()
+
+    def reset_state(self):
+        # changes counts the price changes absorbed so far, so a resumed run knows whether it is still in warmup
+        self.avg_gain, self.avg_loss, self.changes = 0.0, 0.0, 0
 
     def calculate(self, ohclv, idx):
-        lag = len(ohclv.close.data) - 1 - idx
-        last_avg_gain = ohclv.close.average_gain(length=self.length-1, lag=lag+1)
-        last_avg_loss = ohclv.close.average_loss(length=self.length-1, lag=lag+1)
-        current_gain = ohclv.close.average_gain()
-        current_loss = ohclv.close.average_loss()
-        num = (last_avg_gain * (self.length - 1)) + current_gain
-        denom = (last_avg_loss * (self.length - 1)) + current_loss
-        div = num / denom if denom != 0 else 0
-        out = 100 - (100 / (1 + div))
-        return (out,)
+        # Wilder smoothing, seeded with the plain average of the first `length` changes
+        previous, current = ohclv.close[idx-1], ohclv.close[idx]
+        change = (current - previous) / previous * 100 if previous != 0 else 0
+        self.changes += 1
+        smoothing = min(self.changes, self.length)
+        self.avg_gain += (max(change, 0) - self.avg_gain) / smoothing
+        self.avg_loss += (max(-change, 0) - self.avg_loss) / smoothing
+        return (float(self.relative_strength_index(self.avg_gain, self.avg_loss)),)
+
+    def calculate_batch(self, ohclv, start_idx):
+        close = ohclv.close.data[..., start_idx-1:]
+        previous, changes = close[..., :-1], np.diff(close, axis=-1)
+        pct_changes = np.divide(changes, previous, out=np.zeros_like(changes), where=previous != 0) * 100
+        gains, losses = np.maximum(pct_changes, 0), np.maximum(-pct_changes, 0)
+        absorbed = np.asarray(self.changes, dtype=float)
+        avg_gain, avg_loss = np.asarray(self.avg_gain, dtype=float), np.asarray(self.avg_loss, dtype=float)
+        # panel rows can sit at different change counts, so the warmup runs until the least advanced row has `length` changes
+        warmup = int(min(pct_changes.shape[-1], max(0, self.length - np.min(absorbed))))
+
+        head_gain, head_loss = np.empty_like(gains[..., :warmup]), np.empty_like(losses[..., :warmup])
+        for bar in range(warmup):
+            smoothing = np.minimum(absorbed + bar + 1, self.length)
+            avg_gain = avg_gain + (gains[..., bar] - avg_gain) / smoothing
+            avg_loss = avg_loss + (losses[..., bar] - avg_loss) / smoothing
+            head_gain[..., bar], head_loss[..., bar] = avg_gain, avg_loss
+        decay = (self.length - 1) / self.length
+        avg_gain = np.concatenate([head_gain, _linear_recurrence(gains[..., warmup:] / self.length, decay, avg_gain)], axis=-1)
+        avg_loss = np.concatenate([head_loss, _linear_recurrence(losses[..., warmup:] / self.length, decay, avg_loss)], axis=-1)
+        self.avg_gain, self.avg_loss, self.changes = avg_gain[..., -1], avg_loss[..., -1], absorbed + pct_changes.shape[-1]
+        return (self.relative_strength_index(avg_gain, avg_loss),)
+
+    @staticmethod
+    def relative_strength_index(avg_gain, avg_loss):
+        avg_gain, avg_loss = np.asarray(avg_gain, dtype=float), np.asarray(avg_loss, dtype=float)
+        flat = np.where(avg_gain > 0, 100.0, 50.0)
+        rs = np.divide(avg_gain, avg_loss, out=np.zeros_like(avg_gain), where=avg_loss != 0)
+        return np.where(avg_loss != 0, 100 - (100 / (1 + rs)), flat)
     
 def init_indicator(name, *args) -> Indicator:
     match name:
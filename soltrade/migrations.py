@@ -0,0 +1,235 @@
+import re
+import time
+import sqlite3
+from indicators import indicator_table_name, RSI, BOLLINGER
+from log import log_general
+
+# Migration steps run in order, each in its own transaction, and are recorded in schema_version. Every step must be
+# idempotent so a database created by the old one-shot init script can be brought up to date from any point.
+
+def create_base_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS tradeable_assets (
+        token_address TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        platform TEXT NOT NULL,
+        creation_unixtime INTEGER NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS tradeable_asset_info (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        unixtime INTEGER NOT NULL,
+        token_address TEXT NOT NULL,
+        top_10_holders_pct REAL,
+        volume REAL,
+        volume_change_pct REAL,
+        market_cap REAL,
+        liquidity REAL,
+        volume_pct_market_cap REAL,
+        FOREIGN KEY (token_address) REFERENCES tradeable_assets (token_address)
+        ON DELETE CASCADE
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS algorithmic_trades (
+        transactionID TEXT PRIMARY KEY,
+        unixtime INTEGER NOT NULL,
+        token_address TEXT NOT NULL,
+        strategyID TEXT NOT NULL,
+        buy_sell TEXT NOT NULL,
+        price REAL,
+        fees REAL,
+        FOREIGN KEY (token_address) REFERENCES tradeable_assets (token_address)
+        ON DELETE CASCADE
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS portfolio_composition_by_strategy (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        token_address TEXT NOT NULL,
+        strategyID TEXT NOT NULL,
+        token_balance REAL,
+        FOREIGN KEY (token_address) REFERENCES tradeable_assets (token_address)
+        ON DELETE CASCADE
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS portfolio_balances (
+        datetime DATETIME NOT NULL,
+        wallet_address TEXT NOT NULL,
+        usdc_balance REAL,
+        solana_balance REAL,
+        solana_balance_usd REAL,
+        amt_spl_tokens INTEGER,
+        spl_token_balance_usd REAL,
+        total_portfolio_balance_usd REAL
+    )''')
+
+# Clustered on the lookback access pattern; one candle per token, interval and bar
+TRADEABLE_ASSET_PRICES_DDL = '''CREATE TABLE IF NOT EXISTS {table}(
+    token_address TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    unixtime INTEGER NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    volume REAL,
+    PRIMARY KEY (token_address, interval, unixtime),
+    FOREIGN KEY (token_address) REFERENCES tradeable_assets (token_address)
+    ON DELETE CASCADE
+) WITHOUT ROWID'''
+
+def key_tradeable_asset_prices(c):
+    """ Rebuilds a rowid prices table into the keyed layout, dropping duplicate candles (the latest insert wins) """
+    columns = [info[1] for info in c.execute("PRAGMA table_info(tradeable_asset_prices)").fetchall()]
+    if 'id' in columns:
+        c.execute(TRADEABLE_ASSET_PRICES_DDL.format(table='tradeable_asset_prices_keyed'))
+        c.execute('''INSERT OR REPLACE INTO tradeable_asset_prices_keyed (token_address, interval, unixtime, open, high, low, close, volume)
+                     SELECT token_address, COALESCE(interval, ''), unixtime, open, high, low, close, volume
+                     FROM tradeable_asset_prices ORDER BY id''')
+        c.execute("DROP TABLE tradeable_asset_prices")
+        c.execute("ALTER TABLE tradeable_asset_prices_keyed RENAME TO tradeable_asset_prices")
+        log_general.info("Migrated tradeable_asset_prices to the (token_address, interval, unixtime) keyed layout")
+    c.execute("DROP INDEX IF EXISTS idx_tradeable_asset_prices_unixtime_token")
+    c.execute(TRADEABLE_ASSET_PRICES_DDL.format(table='tradeable_asset_prices'))
+
+def quote_column(col) -> str:
+    """ Indicator columns embed their arguments (BOLLINGER_10_2.5_STREAM_1), so they are always written as quoted identifiers """
+    return '"' + col.replace('"', '""') + '"'
+
+def indicator_table_ddl(table, cols) -> str:
+    return f'''CREATE TABLE IF NOT EXISTS {table} (
+        token_address TEXT NOT NULL,
+        unixtime INTEGER NOT NULL,
+        {''.join(f'{quote_column(col)} REAL, ' for col in cols)}PRIMARY KEY (token_address, unixtime)
+    ) WITHOUT ROWID'''
+
+def split_wide_indicator_tables(c):
+    """ Moves each *_STREAM_n column group of the old wide indicator table into its per-(indicator, interval) table """
+    for table in ('tradeable_asset_indicators', 'tradable_asset_indicators'):
+        columns = [info[1] for info in c.execute(f"PRAGMA table_info({table})").fetchall()]
+        if not columns:
+            continue
+        indicator_columns = {}
+        for column in columns:
+            match = re.match(r'^(.+)_STREAM_\d+$', column)
+            if match:
+                indicator_columns.setdefault(match[1], []).append(column)
+        intervals = [row[0] for row in c.execute(f"SELECT DISTINCT interval FROM {table} WHERE interval IS NOT NULL").fetchall()]
+        for indicator_id, cols in indicator_columns.items():
+            for interval in intervals:
+                narrow_table = indicator_table_name(indicator_id, interval)
+                c.execute(indicator_table_ddl(narrow_table, cols))
+                quoted = [quote_column(col) for col in cols]
+                c.execute(f'''INSERT OR REPLACE INTO {narrow_table} (token_address, unixtime, {', '.join(quoted)})
+                              SELECT token_address, unixtime, {', '.join(quoted)} FROM {table}
+                              WHERE interval = ? AND ({' OR '.join(f'{col} IS NOT NULL' for col in quoted)})
+                              ORDER BY id''', (interval,))
+        c.execute(f"DROP TABLE {table}")
+        log_general.info(f"Migrated {len(indicator_columns)} indicators from {table} into per-indicator tables")
+
+def create_covering_indexes(c):
+    # DISTINCT token_address by strategy and token_balance by (token, strategy) are both answered from the index alone
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_portfolio_composition_strategy_token
+                 ON portfolio_composition_by_strategy (strategyID, token_address, token_balance)''')
+    # latest metrics per token: a descending range scan that stops after the first row
+    c.execute("DROP INDEX IF EXISTS idx_tradeable_asset_info_unixtime_token")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tradeable_asset_info_token_unixtime ON tradeable_asset_info (token_address, unixtime DESC)")
+    # per-universe flag columns added before the migration runner existed
+    universe_columns = [info[1] for info in c.execute("PRAGMA table_info(tradeable_assets)").fetchall()
+                        if info[1] not in ('token_address', 'name', 'symbol', 'platform', 'creation_unixtime')]
+    for universe_id in universe_columns:
+        c.execute(universe_index_sql(universe_id))
+
+def create_token_metadata(c):
+    # Birdeye token_security fields, one row per token, shared by every universe; fetched_unixtime drives the per-field TTLs
+    c.execute('''CREATE TABLE IF NOT EXISTS token_metadata (
+        token_address TEXT PRIMARY KEY,
+        creation_time INTEGER,
+        top_10_holders_pct REAL,
+        fetched_unixtime INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+
+MIGRATIONS = [
+    (1, 'base tables', create_base_tables),
+    (2, 'tradeable_asset_prices keyed on (token_address, interval, unixtime)', key_tradeable_asset_prices),
+    (3, 'narrow per-(indicator, interval) indicator tables', split_wide_indicator_tables),
+    (4, 'covering indexes for portfolio, asset info and universe lookups', create_covering_indexes),
+    (5, 'token_metadata cache of token security fields', create_token_metadata),
+]
+
+def universe_index_sql(universe_id) -> str:
+    """ Partial index holding only the tokens currently flagged tradeable for universe_id """
+    return f"CREATE INDEX IF NOT EXISTS idx_tradeable_assets_{universe_id} ON tradeable_assets (token_address) WHERE {universe_id} = TRUE"
+
+def schema_version(conn) -> int:
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_unixtime INTEGER NOT NULL
+    )''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(conn, target=None) -> int:
+    """ Applies every pending step up to target (default: latest) and returns the resulting schema version """
+    current = schema_version(conn)
+    for version, description, step in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, description, applied_unixtime) VALUES (?, ?, ?)", (version, description, int(time.time())))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            log_general.error(f"Schema migration {version} ({description}) failed; database left at version {current}")
+            raise
+        current = version
+        log_general.info(f"Applied schema migration {version}: {description}")
+    return current
+
+def connect(db_path) -> sqlite3.Connection:
+    """ Connection in autocommit mode so migrate() controls its own transactions """
+    return sqlite3.connect(db_path, isolation_level=None)
+
+# Every hot-path query the framework issues against a table, registered through hot_query() by the module that runs it so the
+# checked text is the executed text. Templates take a {universe_id} placeholder; builders are called with (indis, interval).
+# Each must be answered by a primary key or index search; a plain table scan fails check_query_plans.
+HOT_QUERIES = {}
+
+def hot_query(name, query):
+    """ Registers a SQL template or builder under name and returns it unchanged, for use as a module-level constant """
+    HOT_QUERIES[name] = query
+    return query
+
+def full_scans(conn, sql) -> list[str]:
+    """ Tables the query plan reads with a full table or full index scan; scanning a partial index only visits matching rows """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    partial_indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'")}
+    params = (None,) * sql.count('?')
+    scans = []
+    for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+        match = re.match(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX (\w+))?$', row[-1])
+        if match and match[1] in tables and match[2] not in partial_indexes:
+            scans.append(match[1])
+    return scans
+
+def check_query_plans(conn, universe_id=None, indis=None, interval='check'):
+    """ Runs EXPLAIN QUERY PLAN over HOT_QUERIES and raises AssertionError naming every query that would scan a whole table """
+    # importing the query-issuing modules registers their statements
+    import universe, strategy
+    if indis is None:
+        indis = [RSI(14), BOLLINGER(20, 2)]
+    # placeholder universe columns and indicator tables are created inside a transaction that is rolled back
+    conn.execute("BEGIN")
+    try:
+        if universe_id is None:
+            universe_id = 'check_universe'
+            conn.execute(f"ALTER TABLE tradeable_assets ADD COLUMN {universe_id} BOOLEAN DEFAULT FALSE")
+            conn.execute(universe_index_sql(universe_id))
+        for indi in indis:
+            conn.execute(indicator_table_ddl(indi.table_name(interval), indi.cols))
+        failures = {}
+        for name, query in HOT_QUERIES.items():
+            sql = query(indis, interval) if callable(query) else query.format(universe_id=universe_id)
+            scans = full_scans(conn, sql)
+            if scans:
+                failures[name] = scans
+    finally:
+        conn.execute("ROLLBACK")
+    assert not failures, f"Queries falling back to full table scans: {failures}"
@@ -1,56 +1,443 @@
+import re
+import math
+import time
 import asyncio
+import numpy as np
+from functools import lru_cache
+from collections import OrderedDict
 from aiosqlite import connect
 from asyncio import Queue
 from utils import handle_sqlite_lock
 from log import log_general
 
+# Pragmas applied to every new connection; journal_mode is database wide and set once by the writer
+TUNING_PROFILES = {
+    'live': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456, 'temp_store': 'MEMORY'},
+    'backtest': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -262144, 'mmap_size': 1073741824, 'temp_store': 'MEMORY'},
+    'bulk_ingest': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -262144, 'mmap_size': 268435456, 'temp_store': 'MEMORY'},
+}
+
+class LogHistogram:
+    """ Power-of-two bucketed histogram; bucket i counts values in [unit * 2**(i-1), unit * 2**i), bucket 0 everything below unit """
+    __slots__ = ['unit', 'counts']
+
+    def __init__(self, unit=1e-6, n_buckets=32):
+        self.unit = unit
+        self.counts = [0] * n_buckets
+
+    def add(self, value):
+        bucket = math.frexp(value / self.unit)[1] if value >= self.unit else 0
+        self.counts[min(bucket, len(self.counts) - 1)] += 1
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile """
+        total = sum(self.counts)
+        if total == 0:
+            return 0.0
+        running = 0
+        for bucket, count in enumerate(self.counts):
+            running += count
+            if running >= q * total:
+                return self.unit * 2 ** bucket
+        return self.unit * 2 ** (len(self.counts) - 1)
+
+    def snapshot(self):
+        return {self.unit * 2 ** bucket: count for bucket, count in enumerate(self.counts) if count}
+
+class QueryStats:
+    __slots__ = ['count', 'errors', 'rows', 'wait_total', 'exec_total', 'exec_max', 'wait_histogram', 'exec_histogram']
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.wait_total = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+        self.wait_histogram = LogHistogram()
+        self.exec_histogram = LogHistogram()
+
+    def snapshot(self):
+        return {
+            'count': self.count, 'errors': self.errors, 'rows': self.rows,
+            'wait_total': self.wait_total, 'exec_total': self.exec_total, 'exec_max': self.exec_max,
+            'wait_p50': self.wait_histogram.quantile(0.5), 'wait_p99': self.wait_histogram.quantile(0.99),
+            'exec_p50': self.exec_histogram.quantile(0.5), 'exec_p99': self.exec_histogram.quantile(0.99),
+            'wait_histogram': self.wait_histogram.snapshot(), 'exec_histogram': self.exec_histogram.snapshot(),
+        }
+
+class PoolStats:
+    """ In-process counters for a DatabaseConnectionPool: queue depth per queue and wait/exec/rows per normalized SQL template """
+
+    def __init__(self):
+        self.queries = {}
+        self.depths = {'read': LogHistogram(unit=1), 'write': LogHistogram(unit=1)}
+        self.max_depths = {'read': 0, 'write': 0}
+        self.started = time.time()
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def normalize(sql):
+        """ Collapses whitespace and replaces literals so statements differing only in values share a template """
+        sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+        sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+        sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', sql)
+        return ' '.join(sql.split())
+
+    def record_enqueue(self, queue_name, depth):
+        self.depths[queue_name].add(depth)
+        if depth > self.max_depths[queue_name]:
+            self.max_depths[queue_name] = depth
+
+    def record(self, sql, wait, elapsed, result):
+        template = self.normalize(sql)
+        stats = self.queries.get(template)
+        if stats is None:
+            stats = self.queries[template] = QueryStats()
+        stats.count += 1
+        stats.wait_total += wait
+        stats.exec_total += elapsed
+        stats.exec_max = max(stats.exec_max, elapsed)
+        stats.wait_histogram.add(wait)
+        stats.exec_histogram.add(elapsed)
+        if isinstance(result, Exception):
+            stats.errors += 1
+        elif isinstance(result, list):
+            stats.rows += len(result)
+        elif isinstance(result, int) and result > 0:
+            stats.rows += result
+
+    def snapshot(self, queues=None):
+        return {
+            'uptime': time.time() - self.started,
+            'queues': {
+                name: {'depth': queues[name].qsize() if queues else None, 'max_depth': self.max_depths[name], 'depth_histogram': histogram.snapshot()}
+                for name, histogram in self.depths.items()
+            },
+            'queries': {template: stats.snapshot() for template, stats in self.queries.items()},
+        }
+
+    def summary(self, top=10):
+        lines = [f"read queue max depth {self.max_depths['read']}, write queue max depth {self.max_depths['write']}"]
+        ranked = sorted(self.queries.items(), key=lambda item: item[1].exec_total, reverse=True)[:top]
+        for template, stats in ranked:
+            lines.append(f"{stats.count} calls, {stats.errors} errors, {stats.rows} rows, exec {stats.exec_total:.3f}s "
+                         f"(p99 {stats.exec_histogram.quantile(0.99) * 1e3:.2f}ms), wait {stats.wait_total:.3f}s "
+                         f"(p99 {stats.wait_histogram.quantile(0.99) * 1e3:.2f}ms): {template[:120]}")
+        return '\n'.join(lines)
+
+class ReadCache:
+    """ LRU cache of read results keyed by (query, params), invalidated per table by writes made through the same pool """
+    read_tables_pattern = re.compile(r'\b(?:FROM|JOIN)\s+([A-Za-z_]\w*)|\bPRAGMA\s+\w+\s*\(\s*([A-Za-z_]\w*)\s*\)', re.IGNORECASE)
+    write_table_pattern = re.compile(r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM'
+                                     r'|ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?)\s+([A-Za-z_]\w*)', re.IGNORECASE)
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key: (query, params), value: (tables read, result rows)
+        self.keys_by_table = {}
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def read_tables(query) -> tuple:
+        return tuple(sorted({(match[0] or match[1]).lower() for match in ReadCache.read_tables_pattern.findall(query)}))
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def write_table(statement) -> str | None:
+        match = ReadCache.write_table_pattern.match(statement)
+        return match[1].lower() if match else None
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return list(entry[1])
+
+    def generation(self, tables) -> tuple:
+        return tuple(self.generations.get(table, 0) for table in tables)
+
+    def put(self, key, tables, generation, result):
+        # a write that landed while the read was in flight may not be reflected in result, so it is not cached
+        if not tables or generation != self.generation(tables):
+            return
+        self.entries[key] = (tables, list(result))
+        self.entries.move_to_end(key)
+        for table in tables:
+            self.keys_by_table.setdefault(table, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, key):
+        """ Drops the entry and its key from the index of every table it read """
+        tables, _ = self.entries.pop(key)
+        for table in tables:
+            keys = self.keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_table[table]
+
+    def invalidate(self, statement):
+        table = self.write_table(statement)
+        if table is None:
+            # statements we can't attribute to a table drop everything
+            self.generations = {table: generation + 1 for table, generation in self.generations.items()}
+            self.entries.clear()
+            self.keys_by_table.clear()
+            return
+        self.generations[table] = self.generations.get(table, 0) + 1
+        for key in self.keys_by_table.pop(table, ()):
+            self.evict(key)
+
 class DatabaseConnectionPool:
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_workers=4, profile='live', journal_mode=None, group_commit=True, commit_window=0.005, max_batch_size=256, synchronous=None, statement_cache_size=256, stats=True, stats_log_interval=None, read_cache_size=1024):
+        if profile not in TUNING_PROFILES:
+            msg = f"{profile} is not a valid tuning profile; expected one of {list(TUNING_PROFILES)}"
+            log_general.error(msg)
+            raise ValueError(msg)
         self.db_path = db_path
-        self._pool = []
-        self._max_connections = 15
+        self.read_workers = read_workers
+        self.profile = profile
+        self.pragmas = dict(TUNING_PROFILES[profile])
+        if synchronous is not None:
+            self.pragmas['synchronous'] = synchronous
+        self.journal_mode = journal_mode or self.pragmas['journal_mode']
+        del self.pragmas['journal_mode']
+        # sqlite3 keeps this many prepared statements per connection, keyed by SQL text
+        self.statement_cache_size = statement_cache_size
+        # group commit: the writer runs everything queued within commit_window seconds (up to max_batch_size statements)
+        # in one transaction; the synchronous pragma trades durability of the latest commits for fewer fsyncs
+        self.group_commit = group_commit
+        self.commit_window = commit_window
+        self.max_batch_size = max_batch_size
         self.read_queue = asyncio.Queue()
         self.write_queue = asyncio.Queue()
-        asyncio.create_task(self._manage_queue(self.read_queue, self.process_read))
-        asyncio.create_task(self._manage_queue(self.write_queue, self.process_write))
+        self.stats = PoolStats() if stats else None
+        # only writes through this pool invalidate the read cache; writers in other processes are not seen
+        self.read_cache = ReadCache(read_cache_size) if read_cache_size else None
+        self._connections = []
+        # readers wait until the writer has switched the journal mode so they never start on a rollback journal,
+        # and fail with the writer's error instead of connecting when it could not be set up
+        self._journal_ready = asyncio.Event()
+        self._journal_error = None
+        if group_commit:
+            self._workers = [asyncio.create_task(self._manage_write_batches())]
+        else:
+            self._workers = [asyncio.create_task(self._manage_queue(self.write_queue, self.process_write, self._open_writer))]
+        self._workers += [asyncio.create_task(self._manage_queue(self.read_queue, self.process_read, self._open_reader)) for _ in range(read_workers)]
+        if self.stats and stats_log_interval:
+            self._workers.append(asyncio.create_task(self._log_stats(stats_log_interval)))
 
-    async def _create_connection(self):
-        return await connect(self.db_path)
+    async def _create_connection(self, **kwargs):
+        connection = await connect(self.db_path, cached_statements=self.statement_cache_size, **kwargs)
+        self._connections.append(connection)
+        for pragma, value in self.pragmas.items():
+            await connection.execute(f"PRAGMA {pragma}={value}")
+        return connection
 
-    async def _get_connection(self):
-        if self._pool:
-            return self._pool.pop(0)
-        else:
-            return await self._create_connection()
+    async def _open_writer(self, **kwargs):
+        try:
+            connection = await self._create_connection(**kwargs)
+            async with connection.execute(f"PRAGMA journal_mode={self.journal_mode}") as cursor:
+                mode = (await cursor.fetchone())[0]
+            if mode.lower() != self.journal_mode.lower():
+                log_general.warning(f"{self.db_path} could not be switched to journal_mode={self.journal_mode}; running in {mode} mode")
+        except Exception as e:
+            self._journal_error = e
+            raise
+        finally:
+            self._journal_ready.set()
+        return connection
 
-    async def _release_connection(self, connection):
-        if len(self._pool) < self._max_connections:
-            self._pool.append(connection)
-        else:
-            await connection.close()
+    async def _wait_for_journal(self):
+        await self._journal_ready.wait()
+        if self._journal_error is not None:
+            raise self._journal_error
+
+    async def _open_reader(self):
+        await self._wait_for_journal()
+        return await self._create_connection()
 
-    async def _manage_queue(self, queue, process_function):
+    async def _manage_queue(self, queue, process_function, open_connection):
+        # every worker owns one connection for its lifetime: one writer, read_workers concurrent readers
+        connection, connect_error = None, None
+        try:
+            connection = await open_connection()
+        except Exception as e:
+            log_general.error(f"Failed to open a connection to {self.db_path}: {e}")
+            connect_error = e
         while True:
-            query_or_statement, params, fut, is_batch = await queue.get()
-            connection = await self._get_connection()
+            query_or_statement, params, fut, is_batch, enqueued = await queue.get()
+            started = time.perf_counter()
             try:
+                if connection is None:
+                    raise connect_error
                 result = await process_function(query_or_statement, params, connection, is_batch)
-                fut.set_result(result)
             except Exception as e:
-                fut.set_exception(e)
-            finally:
-                await self._release_connection(connection)
+                result = e
+            if queue is self.write_queue and self.read_cache:
+                for statement in self.statement_texts(query_or_statement):
+                    self.read_cache.invalidate(statement)
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+            self._record(query_or_statement, started - enqueued, time.perf_counter() - started, result)
             queue.task_done()
 
-    async def read(self, query, params=None):
+    async def _manage_write_batches(self):
+        connection, connect_error = None, None
+        try:
+            # transactions are issued explicitly by process_write_batch
+            connection = await self._open_writer(isolation_level=None)
+        except Exception as e:
+            log_general.error(f"Failed to open a connection to {self.db_path}: {e}")
+            connect_error = e
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.write_queue.get()]
+            deadline = loop.time() + self.commit_window
+            while len(batch) < self.max_batch_size:
+                if self.write_queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.write_queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.write_queue.get_nowait())
+            started = time.perf_counter()
+            try:
+                if connection is None:
+                    raise connect_error
+                results = await self.process_write_batch(batch, connection)
+            except Exception as e:
+                results = [(e, 0.0)] * len(batch)
+            if self.read_cache:
+                for statement, _, _, _, _ in batch:
+                    for text in self.statement_texts(statement):
+                        self.read_cache.invalidate(text)
+            for (statement, _, fut, _, enqueued), (result, elapsed) in zip(batch, results):
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+                self._record(statement, started - enqueued, elapsed, result)
+                self.write_queue.task_done()
+
+    @staticmethod
+    def statement_texts(statement) -> list[str]:
+        """ SQL of a queued write; a transaction is queued as a tuple of (statement, params, is_batch) steps """
+        return [step[0] for step in statement] if isinstance(statement, tuple) else [statement]
+
+    def _record(self, statement, wait, elapsed, result):
+        if not self.stats:
+            return
+        if isinstance(statement, tuple):
+            # a transaction is recorded as one template with the rows of all its steps
+            statement = '; '.join(self.statement_texts(statement))
+            result = result if isinstance(result, Exception) else sum(max(rowcount, 0) for rowcount in result)
+        self.stats.record(statement, wait, elapsed, result)
+
+    async def _log_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            log_general.info(f"Database pool stats for {self.db_path}:\n{self.stats.summary()}")
+
+    def stats_snapshot(self) -> dict | None:
+        return self.stats.snapshot({'read': self.read_queue, 'write': self.write_queue}) if self.stats else None
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for connection in self._connections:
+            await connection.close()
+        self._connections.clear()
+
+    async def read(self, query, params=None, cache=False):
+        if cache and self.read_cache:
+            return await self.cached_read(query, params)
         fut = asyncio.Future()
-        await self.read_queue.put((query, params, fut, False))  # Read operations are not batched
+        await self.read_queue.put((query, params, fut, False, time.perf_counter()))  # Read operations are not batched
+        if self.stats:
+            self.stats.record_enqueue('read', self.read_queue.qsize())
         return await fut
 
+    async def cached_read(self, query, params=None):
+        key = (query, tuple(params) if params is not None else None)
+        result = self.read_cache.get(key)
+        if result is not None:
+            return result
+        tables = self.read_cache.read_tables(query)
+        generation = self.read_cache.generation(tables)
+        result = await self.read(query, params)
+        self.read_cache.put(key, tables, generation, result)
+        return result
+
+    async def read_chunks(self, query, params=None, chunk_size=4096, dtype=None):
+        """ Yields the result of query in blocks of at most chunk_size rows (record arrays when dtype is given) from a dedicated connection; opening it costs several pooled reads, so this is for scans too long to hold as one result """
+        await self._wait_for_journal()
+        started = time.perf_counter()
+        connection = await self._create_connection()
+        rows, result = 0, None
+        try:
+            async with connection.execute(query, params or ()) as cursor:
+                while True:
+                    chunk = await cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    rows += len(chunk)
+                    yield chunk if dtype is None else np.rec.fromrecords(chunk, dtype=dtype)
+            result = rows
+        except Exception as e:
+            result = e
+            raise
+        finally:
+            self._connections.remove(connection)
+            await connection.close()
+            if self.stats:
+                self.stats.record(query, 0.0, time.perf_counter() - started, result if result is not None else rows)
+
+    async def read_iter(self, query, params=None, chunk_size=4096):
+        """ Yields the rows of query one at a time, fetching chunk_size rows per round trip """
+        chunks = self.read_chunks(query, params, chunk_size)
+        try:
+            async for chunk in chunks:
+                for row in chunk:
+                    yield row
+        finally:
+            await chunks.aclose()
+
+    @staticmethod
+    def is_batch(params):
+        return params and isinstance(params, (list, tuple)) and all(isinstance(p, tuple) for p in params)
+
     async def write(self, statement, params=None):
         fut = asyncio.Future()
-        is_batch = params and isinstance(params, (list, tuple)) and all(isinstance(p, tuple) for p in params)
-        await self.write_queue.put((statement, params, fut, is_batch))
+        await self.write_queue.put((statement, params, fut, self.is_batch(params), time.perf_counter()))
+        if self.stats:
+            self.stats.record_enqueue('write', self.write_queue.qsize())
+        result = await fut
+        return result
+
+    async def transaction(self, statements):
+        """ Writes [(statement, params), ...] in order as one atomic unit and returns each rowcount; a failing step rolls back every step """
+        fut = asyncio.Future()
+        # list params are executemany rows, so a step with no rows is a no-op rather than a binding error
+        steps = tuple((statement, params, isinstance(params, list) or self.is_batch(params)) for statement, params in statements)
+        await self.write_queue.put((steps, None, fut, False, time.perf_counter()))
+        if self.stats:
+            self.stats.record_enqueue('write', self.write_queue.qsize())
         result = await fut
         return result
 
@@ -67,6 +454,15 @@ class DatabaseConnectionPool:
     @staticmethod
     @handle_sqlite_lock()
     async def process_write(statement, params, connection, is_batch=False):
+        if isinstance(statement, tuple):
+            await connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = [await DatabaseConnectionPool.execute_write(connection, *step) for step in statement]
+                await connection.commit()
+            except Exception:
+                await connection.rollback()
+                raise
+            return result
         if is_batch:
             async with connection.executemany(statement, params) as cursor:
                 await connection.commit()
@@ -80,11 +476,54 @@ class DatabaseConnectionPool:
                 await connection.commit()
                 return cursor.rowcount
 
+    @staticmethod
+    async def execute_write(connection, statement, params, is_batch):
+        if is_batch:
+            cursor = await connection.executemany(statement, params)
+        elif params is None:
+            cursor = await connection.execute(statement)
+        else:
+            cursor = await connection.execute(statement, params)
+        rowcount = cursor.rowcount
+        await cursor.close()
+        return rowcount
+
+    @staticmethod
+    @handle_sqlite_lock()
+    async def begin_immediate(connection):
+        await connection.execute("BEGIN IMMEDIATE")
+
+    @staticmethod
+    async def process_write_batch(batch, connection):
+        """ Runs a batch of writes in one transaction, each write or queued transaction under its own savepoint so a failure only rolls back itself; returns (result, seconds) per write """
+        results = []
+        await DatabaseConnectionPool.begin_immediate(connection)
+        try:
+            for statement, params, _, is_batch, _ in batch:
+                started = time.perf_counter()
+                await connection.execute("SAVEPOINT write_batch")
+                try:
+                    if isinstance(statement, tuple):
+                        result = [await DatabaseConnectionPool.execute_write(connection, *step) for step in statement]
+                    else:
+                        result = await DatabaseConnectionPool.execute_write(connection, statement, params, is_batch)
+                except Exception as e:
+                    await connection.execute("ROLLBACK TO write_batch")
+                    result = e
+                await connection.execute("RELEASE write_batch")
+                results.append((result, time.perf_counter() - started))
+            await connection.execute("COMMIT")
+        except Exception:
+            if connection.in_transaction:
+                await connection.execute("ROLLBACK")
+            raise
+        return results
+
 class PoolManager:
     pools = {}
 
     @staticmethod
-    def get_pool(db_path):
+    def get_pool(db_path, **kwargs):
         if db_path not in PoolManager.pools:
-            PoolManager.pools[db_path] = DatabaseConnectionPool(db_path)
+            PoolManager.pools[db_path] = DatabaseConnectionPool(db_path, **kwargs)
         return PoolManager.pools[db_path]
\ No newline at end of file
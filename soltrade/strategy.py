@@ -1,18 +1,34 @@
 import asyncio
+import time
 import aiosqlite
 import aiohttp
+import numpy as np
 import pandas as pd
 from log import log_general, log_transaction
 from utils import handle_rate_limiting_aiohttp
-from datastructures import StreamContainer, PositionContainer
-from indicators import Indicator
+from datastructures import StreamContainer, RingStreamContainer, PositionContainer
+from indicators import Indicator, IndicatorState
 from pooling import DatabaseConnectionPool
+from migrations import indicator_table_ddl, quote_column, hot_query
+from archive import OHLCVArchive
 from wallet import find_balance
 from config import config
 from transactions import perform_swap
 from indicators import init_indicator
 from abc import ABC, abstractmethod
 
+OHLCV_COLUMNS = ['unixtime', 'open', 'high', 'low', 'close', 'volume']
+LAST_OHLCV_QUERY = hot_query('strategy.last_ohlcv', f"""SELECT {', '.join(OHLCV_COLUMNS)}
+                    FROM tradeable_asset_prices
+                    WHERE token_address = ?
+                    AND interval = ?
+                    ORDER BY unixtime 
+                    DESC LIMIT ?""")
+OHLCV_RANGE_QUERY = hot_query('strategy.ohlcv_range', f"SELECT {', '.join(OHLCV_COLUMNS)} FROM tradeable_asset_prices WHERE token_address = ? AND interval = ? AND unixtime >= ? AND unixtime <= ? ORDER BY unixtime ASC")
+PORTFOLIO_TOKENS_QUERY = hot_query('strategy.portfolio_tokens', "SELECT DISTINCT token_address FROM portfolio_composition_by_strategy WHERE strategyID=?")
+TRADEABLE_ASSETS_QUERY = hot_query('strategy.tradeable_assets', "SELECT DISTINCT token_address FROM tradeable_assets WHERE {universe_id} = TRUE")
+BALANCE_QUERY = hot_query('strategy.balance', "SELECT token_balance FROM portfolio_composition_by_strategy WHERE token_address=? AND strategyID=?")
+
 class Strategy(ABC):
     def __init__(self, configs, db_pool):
         self.strategy_id : str = configs.get('strategy_id')
@@ -22,9 +38,15 @@ class Strategy(ABC):
         self.base_token_address : str = configs.get('base_token_address', None)
         self.risk_management : dict = configs.get('risk_management', None)
         self.indicator_dict : dict = configs.get('indicators', None)
+        self.indicator_panel_mode : bool = configs.get('indicator_panel_mode', True)
+        self.resident_streams : dict | None = {} if configs.get('resident_streams', False) else None
+        self.stream_dtype = np.float32 if configs.get('stream_dtype', 'float64') == 'float32' else np.float64
+        self.ohlcv_archive_root : str | None = configs.get('ohlcv_archive', None)
+        self.ohlcv_archives : dict[str, OHLCVArchive] = {}
         self.db_pool : DatabaseConnectionPool = db_pool
         self.positions : PositionContainer = PositionContainer(self.strategy_id)        
         self.indicators : dict[str, Indicator]
+        self.indicator_states : dict[tuple, IndicatorState] = {}
         
         self.simulation_or_backtest = None
         self.new_indicator_database_entries = None
@@ -32,6 +54,8 @@ class Strategy(ABC):
         self.active_price_based_exit_rule = None
         self.session = None
         self.indicator_cols = None
+        self.interval_indicator_cols = None
+        self.joined_ohlcv_and_indicators_queries = None
         self.indis = None
         self.ohclv = None
 
@@ -61,7 +85,7 @@ class Strategy(ABC):
     async def pre_next(self):
         self.token_list = await self.query_tradeable_assets()
         self.current_holdings = await self.query_portfolio_tokens()
-        self.update_ohclv_and_indicators()
+        await self.update_ohclv_and_indicators()
         self.update_buy_size_limit()
 
     @abstractmethod
@@ -82,41 +106,118 @@ class Strategy(ABC):
             for interval in self.indicators 
         }
 
-        for token in self.token_list:
-            for interval, indis in self.indicators.items():
-                data = await self.fetch_joined_ohlcv_and_indicators_data(token, interval, self.lookback_period[interval])
-                columns = ['open', 'high', 'low', 'close', 'volume']
-                data_stream = StreamContainer(data[columns])
-                self.ohclv[token][interval] = data_stream
-                
-                interval_data = []
-
-                for indi in indis:
-                    fetched_indi_cols = data[list(indi.cols)]
-                    indi_stream = StreamContainer(fetched_indi_cols, indi.stream_aliases)
-                    full_calcs, new_idxs = indi.next(data_stream, indi_stream)
-                    
-                    start_idx, end_idx = new_idxs
-                    new_entries_data = {
-                        indi.alias_to_cols[alias]: stream.data[start_idx:end_idx+1]
-                        for alias, stream in full_calcs.streams.items()
-                    }
-                    
-                    new_entries_df = pd.DataFrame(new_entries_data, index=full_calcs.index[start_idx:end_idx+1])
-                    new_entries_df['unixtime'] = new_entries_df.index
-                    new_entries_df['token_address'] = token
-                    new_entries_df['interval'] = interval
-                    
-                    interval_data.append(new_entries_df)
-
-                    self.indis[token][interval][indi.id] = full_calcs
-
-                if interval_data:
-                    combined_interval_data = pd.concat(interval_data, axis=1)
-                    combined_interval_data = combined_interval_data.loc[:,~combined_interval_data.columns.duplicated()]
-                    self.new_indicator_database_entries[interval] = pd.concat(
-                        [self.new_indicator_database_entries[interval], combined_interval_data], ignore_index=True
-                    )
+        self.ohclv = {token: {} for token in self.token_list}
+
+        for interval, indis in self.indicators.items():
+            if self.resident_streams is not None:
+                for token in self.token_list:
+                    await self.update_resident_streams(token, interval, indis)
+                continue
+            frames = {}
+            for token in self.token_list:
+                frames[token] = await self.fetch_joined_ohlcv_and_indicators_block(token, interval, self.lookback_period[interval])
+            for tokens in self.group_tokens_for_panel(frames):
+                self.update_indicator_panel(interval, indis, tokens, frames)
+
+        if self.resident_streams is not None:
+            active_tokens = set(self.token_list)
+            for key in [key for key in self.resident_streams if key[0] not in active_tokens]:
+                del self.resident_streams[key]
+
+    def group_tokens_for_panel(self, frames: dict) -> list[list]:
+        if not self.indicator_panel_mode:
+            return [[token] for token in frames]
+        groups = {}
+        for token, data in frames.items():
+            groups.setdefault(tuple(data.unixtime), []).append(token)
+        return list(groups.values())
+
+    def update_indicator_panel(self, interval, indis, tokens, frames):
+        """ Evaluates every indicator of an interval once across tokens whose candles share the same unixtimes """
+        columns = ['open', 'high', 'low', 'close', 'volume']
+        unixtime = frames[tokens[0]].unixtime
+        data_stream = StreamContainer.from_arrays(unixtime, {
+            column: np.vstack([frames[token][column].data for token in tokens]) for column in columns
+        })
+        for row, token in enumerate(tokens):
+            self.ohclv[token][interval] = data_stream.row(row)
+
+        interval_data = {token: [] for token in tokens}
+
+        for indi in indis:
+            indi_stream = StreamContainer.from_arrays(unixtime, {
+                alias: np.vstack([frames[token][col].data for token in tokens]) for alias, col in indi.alias_to_cols.items()
+            })
+            state_keys = [(token, interval, indi.id) for token in tokens]
+            new_idxs, states = indi.next_panel(data_stream, indi_stream, [self.indicator_states.get(key) for key in state_keys])
+
+            for row, token in enumerate(tokens):
+                self.indicator_states[state_keys[row]] = states[row]
+                full_calcs = indi_stream.row(row)
+                self.indis[token][interval][indi.id] = full_calcs
+                new_entries_df = self.new_indicator_entries(token, interval, indi, full_calcs, new_idxs[row])
+                if new_entries_df is not None:
+                    interval_data[token].append(new_entries_df)
+
+        for token_data in interval_data.values():
+            self.add_new_indicator_database_entries(interval, token_data)
+
+    async def update_resident_streams(self, token, interval, indis):
+        """ Live mode: pushes only the candles newer than the resident ring buffers and advances each indicator over them """
+        columns = ['open', 'high', 'low', 'close', 'volume']
+        key = (token, interval)
+        if key not in self.resident_streams:
+            capacity = self.lookback_period[interval]
+            data = await self.fetch_joined_ohlcv_and_indicators_block(token, interval, capacity)
+            data_stream = RingStreamContainer(columns, capacity, self.stream_dtype)
+            data_stream.extend(np.asarray(data.unixtime), data.block[:, :len(columns)])
+            indi_streams = {}
+            for indi in indis:
+                indi_streams[indi.id] = RingStreamContainer(indi.stream_aliases, capacity, self.stream_dtype)
+                indi_streams[indi.id].extend(np.asarray(data.unixtime), np.column_stack([data[col].data for col in indi.cols]))
+            self.resident_streams[key] = (data_stream, indi_streams)
+        else:
+            data_stream, indi_streams = self.resident_streams[key]
+            data = await self.fetch_ohlcv_data_range(token, interval, data_stream.last_unixtime + 1, int(time.time()))
+            if not data.empty:
+                data_stream.extend(data['unixtime'].to_numpy(), data[columns].to_numpy(dtype=float))
+                missing = np.full((len(data), 1), np.nan)
+                for indi_stream in indi_streams.values():
+                    indi_stream.extend(data['unixtime'].to_numpy(), np.repeat(missing, len(indi_stream.streams), axis=1))
+
+        self.ohclv[token][interval] = data_stream
+        interval_data = []
+        for indi in indis:
+            state_key = (token, interval, indi.id)
+            full_calcs, new_idxs, self.indicator_states[state_key] = indi.next(data_stream, indi_streams[indi.id], self.indicator_states.get(state_key))
+            self.indis[token][interval][indi.id] = full_calcs
+            new_entries_df = self.new_indicator_entries(token, interval, indi, full_calcs, new_idxs)
+            if new_entries_df is not None:
+                interval_data.append(new_entries_df)
+        self.add_new_indicator_database_entries(interval, interval_data)
+
+    def new_indicator_entries(self, token, interval, indi, full_calcs, new_idxs) -> pd.DataFrame | None:
+        start_idx, end_idx = new_idxs
+        if start_idx > end_idx:
+            return None
+        new_entries_data = {
+            indi.alias_to_cols[alias]: stream.data[start_idx:end_idx+1]
+            for alias, stream in full_calcs.streams.items()
+        }
+        
+        new_entries_df = pd.DataFrame(new_entries_data, index=full_calcs.unixtime[start_idx:end_idx+1])
+        new_entries_df['unixtime'] = new_entries_df.index
+        new_entries_df['token_address'] = token
+        new_entries_df['interval'] = interval
+        return new_entries_df
+
+    def add_new_indicator_database_entries(self, interval, token_data: list[pd.DataFrame]):
+        if token_data:
+            combined_interval_data = pd.concat(token_data, axis=1)
+            combined_interval_data = combined_interval_data.loc[:,~combined_interval_data.columns.duplicated()]
+            self.new_indicator_database_entries[interval] = pd.concat(
+                [self.new_indicator_database_entries[interval], combined_interval_data], ignore_index=True
+            )
 
     async def get_prices_for_all_current_holdings(self):
         return 
@@ -164,81 +265,139 @@ class Strategy(ABC):
             return response
 
     async def fetch_last_ohlcv_data(self, token_address, interval, length):
-        columns = ['unixtime', 'open', 'high', 'low', 'close', 'volume']
-        query = f"""SELECT {', '.join(columns)}
-                    FROM tradable_asset_prices
-                    WHERE token_address = ?
-                    AND interval = ?
-                    ORDER BY datetime 
-                    DESC LIMIT ?"""
         params = (token_address, interval, length)
-        data = await self.db_pool.read(query, params)
-        return pd.DataFrame(data, columns=columns)
+        data = await self.db_pool.read(LAST_OHLCV_QUERY, params)
+        return pd.DataFrame(data, columns=OHLCV_COLUMNS)
+
+    def range_dtype(self, columns) -> list:
+        return [('unixtime', np.int64)] + [(col, self.stream_dtype) for col in columns]
+
+    def iter_ohlcv_data_range(self, token_address, interval, unixtimestart, unixtimeend, chunk_size=4096):
+        """ Streams the range as record arrays of at most chunk_size bars, for scans too long to hold as one result """
+        params = (token_address, interval, unixtimestart, unixtimeend)
+        return self.db_pool.read_chunks(OHLCV_RANGE_QUERY, params, chunk_size, dtype=self.range_dtype(OHLCV_COLUMNS[1:]))
+
+    def ohlcv_archive(self, interval) -> OHLCVArchive | None:
+        """ Memory-mapped archive for backtests, when an archive root is configured and holds the interval """
+        if self.ohlcv_archive_root is None:
+            return None
+        if interval not in self.ohlcv_archives:
+            try:
+                self.ohlcv_archives[interval] = OHLCVArchive(self.ohlcv_archive_root, interval)
+            except FileNotFoundError:
+                log_general.warning(f"No {interval} OHLCV archive under {self.ohlcv_archive_root}; reading from the database")
+                self.ohlcv_archives[interval] = None
+        return self.ohlcv_archives[interval]
 
     async def fetch_ohlcv_data_range(self, token_address, interval, unixtimestart, unixtimeend):
-        columns = ['unixtime', 'open', 'high', 'low', 'close', 'volume']
-        query = f"SELECT {', '.join(columns)} FROM tradable_asset_prices WHERE token_address = ? AND interval = ? AND unixtime >= ? AND unixtime <= ? ORDER BY unixtime ASC"
+        """ Reads the part of the range the archive covers from the archive and anything newer than its export from the database """
+        archive = self.ohlcv_archive(interval)
+        archived = None
+        if archive is not None and token_address in archive:
+            archived = pd.DataFrame(archive.slice(token_address, unixtimestart, unixtimeend), columns=OHLCV_COLUMNS)
+            archived_until = archive.last_unixtime(token_address)
+            if unixtimeend <= archived_until:
+                return archived
+            unixtimestart = max(unixtimestart, archived_until + 1)
+        # a DataFrame holds the whole range anyway, so it is read through the pooled readers and their statement caches
+        rows = await self.db_pool.read(OHLCV_RANGE_QUERY, (token_address, interval, unixtimestart, unixtimeend))
+        data = pd.DataFrame(np.rec.fromrecords(rows, dtype=self.range_dtype(OHLCV_COLUMNS[1:]))) if rows else pd.DataFrame(columns=OHLCV_COLUMNS)
+        if archived is None or archived.empty:
+            return data
+        return pd.concat([archived, data], ignore_index=True) if not data.empty else archived
+
+    @staticmethod
+    def indicator_joins(indis, interval, driver) -> tuple[list, str]:
+        """ Select columns and LEFT JOINs attaching each indicator's narrow table to the driver rows' (token_address, unixtime) """
+        select_columns, joins = [], []
+        for i, indi in enumerate(indis):
+            select_columns += [f'i{i}.{quote_column(col)}' for col in indi.cols]
+            joins.append(f"LEFT JOIN {indi.table_name(interval)} i{i} ON i{i}.token_address = {driver}.token_address AND i{i}.unixtime = {driver}.unixtime")
+        return select_columns, '\n'.join(joins)
+
+    def iter_indicators_data_range(self, token_address, interval, unixtimestart, unixtimeend, chunk_size=4096):
+        """ Streams the range as record arrays of at most chunk_size bars, for scans too long to hold as one result; missing indicator values become NaN """
+        query = self.build_indicators_range_query(self.indicators[interval], interval)
         params = (token_address, interval, unixtimestart, unixtimeend)
-        data = await self.db_pool.read(query, params)
-        return pd.DataFrame(data, columns=columns)
-    
+        return self.db_pool.read_chunks(query, params, chunk_size, dtype=self.range_dtype(self.interval_indicator_cols[interval]))
+
     async def fetch_indicators_data_range(self, token_address, interval, unixtimestart, unixtimeend):
-        columns = ', '.join(['unixtime'] + self.indicator_cols)
-        query = f"SELECT {columns} FROM tradable_asset_indicators WHERE token_address = ? AND interval = ? AND unixtime >= ? AND unixtime <= ? ORDER BY unixtime ASC"
-        params = (token_address, interval, unixtimestart, unixtimeend)
-        data = await self.db_pool.read(query, params)
-        return pd.DataFrame(data, columns=columns.split(", "))
+        query = self.build_indicators_range_query(self.indicators[interval], interval)
+        rows = await self.db_pool.read(query, (token_address, interval, unixtimestart, unixtimeend))
+        columns = ['unixtime'] + self.interval_indicator_cols[interval]
+        return pd.DataFrame(np.rec.fromrecords(rows, dtype=self.range_dtype(columns[1:]))) if rows else pd.DataFrame(columns=columns)
     
-    async def fetch_joined_ohlcv_and_indicators_data(self, token_address, interval, length, unixtimestart, unixtimeend):
+    @classmethod
+    def build_indicators_range_query(cls, indis, interval):
+        select_columns, joins = cls.indicator_joins(indis, interval, 'p')
+        return f"""SELECT p.unixtime{''.join(', ' + col for col in select_columns)}
+                    FROM tradeable_asset_prices p
+                    {joins}
+                    WHERE p.token_address = ? AND p.interval = ? AND p.unixtime >= ? AND p.unixtime <= ?
+                    ORDER BY p.unixtime ASC"""
+
+    @classmethod
+    def build_joined_ohlcv_and_indicators_query(cls, indis, interval):
         ohlcv_columns = ['unixtime', 'open', 'high', 'low', 'close', 'volume']
-        indicator_columns = [f'a.{col}' for col in self.indicator_cols]
-        subquery_ohlcv = f"""SELECT {', '.join(ohlcv_columns)}
-                            FROM tradable_asset_prices
+        indicator_columns, joins = cls.indicator_joins(indis, interval, 'last_ohlcv')
+        select_columns = [f'last_ohlcv.{col}' for col in ohlcv_columns] + indicator_columns
+        subquery_ohlcv = f"""SELECT token_address, {', '.join(ohlcv_columns)}
+                            FROM tradeable_asset_prices
                             WHERE token_address = ? AND interval = ?
-                            ORDER BY datetime 
+                            ORDER BY unixtime 
                             DESC LIMIT ? """
-        main_query = f"""WITH last_ohlcv AS ({subquery_ohlcv})
-                        SELECT last_ohlcv.*, {', '.join(indicator_columns)}
+        return f"""WITH last_ohlcv AS ({subquery_ohlcv})
+                        SELECT {', '.join(select_columns)}
                         FROM last_ohlcv
-                        LEFT JOIN tradable_asset_indicators a ON last_ohlcv.unixtime = a.unixtime
-                        AND last_ohlcv.token_address = a.token_address
-                        AND last_ohlcv.interval = a.interval
+                        {joins}
                         ORDER BY last_ohlcv.unixtime ASC
                         """
+
+    async def fetch_joined_ohlcv_and_indicators_rows(self, token_address, interval, length):
         params = (token_address, interval, length)
-        data = await self.db_pool.read(main_query, params)
-        columns = ohlcv_columns + self.indicator_cols
+        return await self.db_pool.read(self.joined_ohlcv_and_indicators_queries[interval], params)
+
+    async def fetch_joined_ohlcv_and_indicators_data(self, token_address, interval, length):
+        data = await self.fetch_joined_ohlcv_and_indicators_rows(token_address, interval, length)
+        columns = ['unixtime', 'open', 'high', 'low', 'close', 'volume'] + self.interval_indicator_cols[interval]
         df = pd.DataFrame(data, columns=columns)
         df.set_index('unixtime', inplace=True)
         return df
 
+    async def fetch_joined_ohlcv_and_indicators_block(self, token_address, interval, length) -> StreamContainer:
+        """ Same window as fetch_joined_ohlcv_and_indicators_data, as one contiguous block container without a DataFrame """
+        data = await self.fetch_joined_ohlcv_and_indicators_rows(token_address, interval, length)
+        return StreamContainer.from_rows(data, ['open', 'high', 'low', 'close', 'volume'] + self.interval_indicator_cols[interval], dtype=self.stream_dtype)
+
     async def query_portfolio_tokens(self):
-        query = "SELECT DISTINCT token_address FROM portfolio_composition_by_strategy WHERE strategyID=?"
-        params = (self.strategyID,)
-        rows = await self.db_pool.read(query, params)
+        params = (self.strategy_id,)
+        rows = await self.db_pool.read(PORTFOLIO_TOKENS_QUERY, params, cache=True)
         tokens = [row[0] for row in rows]
         return tokens
     
     async def query_tradeable_assets(self):
-        query = "SELECT DISTINCT token_address FROM tradeable_assets WHERE ?=TRUE"
-        params = (self.strategyID,)
-        rows = await self.db_pool.read(query, params)
+        rows = await self.db_pool.read(TRADEABLE_ASSETS_QUERY.format(universe_id=self.universe_id), cache=True)
         tokens = [row[0] for row in rows]
         return tokens
 
     async def get_balance(self, token_address):
-        query = "SELECT token_balance FROM portfolio_composition_by_strategy WHERE token_address=? AND strategyID=?"
-        params = (token_address, self.strategyID)
-        balance = await self.db_pool.read(query, params)
+        params = (token_address, self.strategy_id)
+        balance = await self.db_pool.read(BALANCE_QUERY, params)
         return balance[0] if balance else 0
 
     async def insert_into_indicator_database(self):
         for interval, df in self.new_indicator_database_entries.items():
-            if not df.empty:
-                columns = ', '.join(df.columns)
-                placeholders = ', '.join(['?' for _ in df.columns])
-                sql = f"INSERT INTO tradeable_asset_indicators ({columns}) VALUES ({placeholders})"
-                data_tuples = [tuple(row) for row in df.itertuples(index=False, name=None)]
+            if df.empty:
+                continue
+            for indi in self.indicators[interval]:
+                # each indicator only writes its own narrow table, and only the bars it produced values for
+                rows = df.loc[df[list(indi.cols)].notna().any(axis=1), ['token_address', 'unixtime'] + list(indi.cols)]
+                if rows.empty:
+                    continue
+                columns = ', '.join(quote_column(col) for col in rows.columns)
+                placeholders = ', '.join(['?' for _ in rows.columns])
+                sql = f"INSERT OR REPLACE INTO {indi.table_name(interval)} ({columns}) VALUES ({placeholders})"
+                data_tuples = [tuple(row) for row in rows.itertuples(index=False, name=None)]
                 await self.db_pool.write(sql, data_tuples)
 
     async def init_indicators(self):
@@ -254,18 +413,20 @@ class Strategy(ABC):
             interval_indicators[interval] = indicator_instances
         self.indicators = interval_indicators
         indicator_cols = list(set(indicator_cols))
-        await self.init_db_columns(indicator_cols)
-
-    async def init_db_columns(self, names):
-        query = "PRAGMA table_info(tradable_asset_indicators)"
-        columns_info = await self.db_pool.read(query)
-        columns = [info[1] for info in columns_info]
-        for name in names:
-            if name not in columns:
-                alter_query = f"ALTER TABLE tradable_asset_indicators ADD COLUMN {name} REAL"
-                await self.db_pool.write(alter_query)
-                log_general.info(f"Column {name} added to tradable_asset_indicators")
+        self.indicator_cols = indicator_cols
+        self.interval_indicator_cols = {interval: [col for indi in indis for col in indi.cols] for interval, indis in interval_indicators.items()}
+        # the column lists are fixed from here on, so each interval's hot lookback query is one constant prepared statement
+        self.joined_ohlcv_and_indicators_queries = {interval: self.build_joined_ohlcv_and_indicators_query(indis, interval) for interval, indis in interval_indicators.items()}
+        await self.init_indicator_tables()
+
+    async def init_indicator_tables(self):
+        for interval, indis in self.indicators.items():
+            for indi in indis:
+                await self.db_pool.write(indicator_table_ddl(indi.table_name(interval), indi.cols))
     
     @property 
     def current_holdings(self):
-        return [token_address for token_address in self.positions.active_holdings.keys()]
\ No newline at end of file
+        return [token_address for token_address in self.positions.active_holdings.keys()]
+
+hot_query('strategy.indicator_range', Strategy.build_indicators_range_query)
+hot_query('strategy.joined_lookback', Strategy.build_joined_ohlcv_and_indicators_query)
@@ -1,13 +1,116 @@
 import requests
 import json
 import time
+import asyncio
+import itertools
 import aiosqlite
+from collections import deque
 import aiohttp
 from log import log_general
 from config import config
 from pooling import DatabaseConnectionPool
+from migrations import universe_index_sql, hot_query
 from utils import *
 
+# universe_id is a column name, so these are templates formatted once per universe and then reused verbatim from the statement cache
+SET_TRADEABLE_FALSE_SQL = hot_query('universe.set_tradeable_false', "UPDATE tradeable_assets SET {universe_id} = FALSE WHERE {universe_id} = TRUE")
+SET_TRADEABLE_TRUE_SQL = hot_query('universe.set_tradeable_true', "UPDATE tradeable_assets SET {universe_id} = TRUE WHERE token_address = ?")
+CURRENTLY_TRADEABLE_QUERY = hot_query('universe.currently_tradeable', "SELECT token_address FROM tradeable_assets WHERE {universe_id} = TRUE")
+# membership refresh: the new token set is bound once as a JSON array, so only rows whose flag changes are written
+LEAVE_UNIVERSE_SQL = hot_query('universe.leave_universe', '''UPDATE tradeable_assets SET {universe_id} = FALSE
+        WHERE {universe_id} = TRUE AND token_address NOT IN (SELECT value FROM json_each(?))''')
+JOIN_UNIVERSE_SQL = hot_query('universe.join_universe', '''UPDATE tradeable_assets SET {universe_id} = TRUE
+        WHERE token_address IN (SELECT value FROM json_each(?)) AND {universe_id} IS NOT TRUE''')
+INSERT_NEW_ASSET_INFO_SQL = hot_query('universe.insert_new_asset_info', '''INSERT INTO tradeable_asset_info (unixtime, token_address, top_10_holders_pct, volume,
+        volume_change_pct, market_cap, liquidity, volume_pct_market_cap)
+        SELECT ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM tradeable_assets WHERE token_address = ?)''')
+INSERT_NEW_ASSET_SQL = hot_query('universe.insert_new_asset', '''INSERT INTO tradeable_assets (token_address, name, symbol, platform, creation_unixtime, {universe_id})
+        VALUES (?, ?, ?, ?, ?, TRUE) ON CONFLICT (token_address) DO NOTHING''')
+# one primary key seek per token for the latest candle, instead of a query per token
+LAST_OHLCV_UNIXTIMES_QUERY = hot_query('universe.last_ohlcv_unixtimes', '''SELECT t.token_address, t.creation_unixtime,
+        (SELECT MAX(p.unixtime) FROM tradeable_asset_prices p WHERE p.token_address = t.token_address AND p.interval = ?)
+        FROM tradeable_assets t WHERE t.{universe_id} = TRUE''')
+TOKEN_EXISTS_QUERY = hot_query('universe.token_exists', "SELECT 1 FROM tradeable_assets WHERE token_address = ?")
+LAST_OHLCV_UNIXTIME_QUERY = hot_query('universe.last_ohlcv_unixtime', "SELECT unixtime FROM tradeable_asset_prices WHERE token_address = ? AND interval = ? ORDER BY unixtime DESC LIMIT 1")
+CREATION_UNIXTIME_QUERY = hot_query('universe.creation_unixtime', "SELECT creation_unixtime FROM tradeable_assets WHERE token_address = ?")
+# overlapping fetch windows re-deliver candles; the latest values for a bar win
+UPSERT_PRICES_SQL = hot_query('universe.upsert_prices', '''INSERT INTO tradeable_asset_prices (token_address, unixtime, open, high, low, close, volume, interval)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (token_address, interval, unixtime) DO UPDATE SET
+        open = excluded.open, high = excluded.high, low = excluded.low, close = excluded.close, volume = excluded.volume''')
+
+class TokenMetadataCache:
+    """ Token security fields persisted in token_metadata and held in memory, shared by every universe on the same database """
+    caches = {}
+    fields = ['creation_time', 'top_10_holders_pct']
+    upsert_sql = hot_query('universe.token_metadata_upsert', '''INSERT INTO token_metadata (token_address, creation_time, top_10_holders_pct, fetched_unixtime)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (token_address) DO UPDATE SET
+                    creation_time = COALESCE(excluded.creation_time, creation_time),
+                    top_10_holders_pct = excluded.top_10_holders_pct, fetched_unixtime = excluded.fetched_unixtime''')
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.entries = {}  # key: token_address, value: (creation_time, top_10_holders_pct, fetched_unixtime)
+        self.pending = {}  # key: token_address, value: in-flight lookup shared by concurrent callers
+        self.warmed = False
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def shared(db_pool):
+        if db_pool.db_path not in TokenMetadataCache.caches:
+            TokenMetadataCache.caches[db_pool.db_path] = TokenMetadataCache(db_pool)
+        return TokenMetadataCache.caches[db_pool.db_path]
+
+    async def warm(self):
+        if self.warmed:
+            return
+        rows = await self.db_pool.read("SELECT token_address, creation_time, top_10_holders_pct, fetched_unixtime FROM token_metadata")
+        for token_address, *entry in rows:
+            self.entries.setdefault(token_address, tuple(entry))
+        self.warmed = True
+        log_general.info(f"Token metadata cache warmed with {len(rows)} tokens from {self.db_pool.db_path}")
+
+    def get(self, token_address, ttls) -> dict | None:
+        """ Cached fields if the token was fetched and each field is younger than its TTL in seconds (None never expires), else None """
+        entry = self.entries.get(token_address)
+        if entry is None:
+            return None
+        # a field Birdeye returned as null is cached as None like any other value, so it is not refetched every refresh
+        age = int(time.time()) - entry[-1]
+        for field in self.fields:
+            ttl = ttls.get(field)
+            if ttl is not None and age > ttl:
+                return None
+        return dict(zip(self.fields, entry))
+
+    async def lookup(self, token_address, ttls, fetch) -> dict | None:
+        """ Fresh cached fields, otherwise the result of await fetch(token_address), stored for every later caller """
+        cached = self.get(token_address, ttls)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        if token_address not in self.pending:
+            self.pending[token_address] = asyncio.ensure_future(self._refresh(token_address, fetch))
+        # shielded so a cancelled caller does not abort a lookup other universes are waiting on
+        return await asyncio.shield(self.pending[token_address])
+
+    async def _refresh(self, token_address, fetch):
+        try:
+            data = await fetch(token_address)
+            if data is None:
+                return None
+            previous = self.entries.get(token_address, (None,))
+            creation_time = convert_or_default(data.get('creationTime'), int, None) or previous[0]
+            top10holderspct = convert_or_default(data.get('top_10_holders_pct'), float, None)
+            now = int(time.time())
+            self.entries[token_address] = (creation_time, top10holderspct, now)
+            await self.db_pool.write(self.upsert_sql, (token_address, creation_time, top10holderspct, now))
+            return dict(zip(self.fields, self.entries[token_address]))
+        finally:
+            del self.pending[token_address]
+
 class Universe:
     def __init__(self, configs, db_pool):
         self.universe_id = configs.get('universe_id')
@@ -25,12 +128,31 @@ class Universe:
         self.min_liquidity = configs.get('min_liquidity')
         self.min_volume_pct_market_cap_quintile = configs.get('min_volume_pct_market_cap_quintile')
         self.min_volume_change_pct_quintile = configs.get('min_volume_change_pct_quintile')
+        self.token_list_prefetch_pages = configs.get('token_list_prefetch_pages', 4)
+        self.security_lookup_concurrency = configs.get('security_lookup_concurrency', 8)
+        self.ohlcv_fetch_concurrency = configs.get('ohlcv_fetch_concurrency', 8)
+        self.metadata_ttls = {
+            'creation_time': None,
+            'top_10_holders_pct': configs.get('top_10_holders_pct_ttl_minutes', 1440) * 60
+        }
         self.db_pool = db_pool
+        self.metadata_cache = TokenMetadataCache.shared(db_pool)
+        self.set_tradeable_to_false_sql = SET_TRADEABLE_FALSE_SQL.format(universe_id=self.universe_id)
+        self.set_tradeable_to_true_sql = SET_TRADEABLE_TRUE_SQL.format(universe_id=self.universe_id)
+        self.currently_tradeable_query = CURRENTLY_TRADEABLE_QUERY.format(universe_id=self.universe_id)
+        self.leave_universe_sql = LEAVE_UNIVERSE_SQL.format(universe_id=self.universe_id)
+        self.join_universe_sql = JOIN_UNIVERSE_SQL.format(universe_id=self.universe_id)
+        self.insert_new_asset_info_sql = INSERT_NEW_ASSET_INFO_SQL.format(universe_id=self.universe_id)
+        self.insert_new_asset_sql = INSERT_NEW_ASSET_SQL.format(universe_id=self.universe_id)
+        self.last_ohlcv_unixtimes_query = LAST_OHLCV_UNIXTIMES_QUERY.format(universe_id=self.universe_id)
         self.headers = {
             "x-chain": self.platform,
             "X-API-KEY": config().get('birdeye_api_key')
         }
         self.session = None
+        # bounds the token_security requests in flight across every refresh this universe runs
+        self.security_lookup_semaphore = asyncio.Semaphore(self.security_lookup_concurrency)
+        self.ohlcv_fetch_semaphore = asyncio.Semaphore(self.ohlcv_fetch_concurrency)
 
     @classmethod
     async def create(cls, configs, db_pool):
@@ -40,6 +162,7 @@ class Universe:
         assert instance.intervals is not None and isinstance(instance.platform, list), "intervals must be a non-empty list"
         assert instance.db_pool is not None and isinstance(instance.db_pool, DatabaseConnectionPool), "db_pool must be a DatabaseConnectionPool object"
         await instance.init_db_column()
+        await instance.metadata_cache.warm()
         return instance
 
     async def open_aiohttp_session(self):
@@ -52,21 +175,20 @@ class Universe:
 
     async def init_db_column(self):
         query = "PRAGMA table_info(tradeable_assets)"
-        columns_info = await self.db_pool.read(query)
+        columns_info = await self.db_pool.read(query, cache=True)
         columns = [info[1] for info in columns_info]
         
         if self.universe_id not in columns:
             alter_query = f"ALTER TABLE tradeable_assets ADD COLUMN {self.universe_id} BOOLEAN DEFAULT FALSE"
             await self.db_pool.write(alter_query)
+        await self.db_pool.write(universe_index_sql(self.universe_id))
             
     async def set_currently_tradeable_to_false(self):
-        update_query = f"UPDATE tradeable_assets SET {self.universe_id} = FALSE"
-        await self.db_pool.write(update_query)
+        await self.db_pool.write(self.set_tradeable_to_false_sql)
 
     async def set_currently_tradeable_to_true(self, token_address):
-        update_query = f"UPDATE tradeable_assets SET {self.universe_id} = TRUE WHERE token_address = ?"
         params = (token_address,)
-        await self.db_pool.write(update_query, params)
+        await self.db_pool.write(self.set_tradeable_to_true_sql, params)
 
     @handle_rate_limiting_aiohttp()
     async def fetch_token_security_info(self, token_address):
@@ -74,6 +196,11 @@ class Universe:
         async with self.session.get(url, headers=self.headers) as response:
             return response
     
+    async def fetch_token_security_data(self, token_address):
+        async with self.security_lookup_semaphore:
+            security_info = await self.fetch_token_security_info(token_address)
+        return (security_info or {}).get('data')
+
     @handle_rate_limiting_aiohttp()
     async def fetch_token_list_page(self, offset):
         url = f"https://public-api.birdeye.so/public/tokenlist?sort_by={self.token_list_sort_by}&sort_type={self.token_list_sort_type}&offset={offset}&limit={self.page_limit}"
@@ -87,26 +214,27 @@ class Universe:
             return response
     
     async def get_all_currently_tradeable_assets(self):
-        query = f"SELECT token_address FROM tradeable_assets WHERE {self.universe_id} = TRUE"
-        rows = await self.db_pool.read(query)
+        rows = await self.db_pool.read(self.currently_tradeable_query, cache=True)
         return [row[0] for row in rows]
 
     async def token_exists_in_database(self, token_address):
-        query = "SELECT 1 FROM tradeable_assets WHERE token_address = ?"
         params = (token_address,)
-        result = await self.db_pool.read(query, params)
+        result = await self.db_pool.read(TOKEN_EXISTS_QUERY, params, cache=True)
         return bool(result) 
     
     async def last_ohclv_update_unixtime(self, token_address, interval):
-        query = "SELECT unixtime FROM tradeable_asset_prices WHERE token_address = ? AND interval = ? ORDER BY unixtime DESC LIMIT 1"
         params = (token_address, interval)
-        result = await self.db_pool.read(query, params)
+        result = await self.db_pool.read(LAST_OHLCV_UNIXTIME_QUERY, params)
         return result[0][0] if result else None
 
+    async def last_ohlcv_update_unixtimes(self, interval) -> dict:
+        """ token_address -> (creation_unixtime, latest candle unixtime or None) for every currently tradeable token """
+        rows = await self.db_pool.read(self.last_ohlcv_unixtimes_query, (interval,))
+        return {token_address: (creation_unixtime, last_unixtime) for token_address, creation_unixtime, last_unixtime in rows}
+
     async def get_token_creation_unixtime(self, token_address):
-        query = "SELECT creation_unixtime FROM tradeable_assets WHERE token_address = ?"
         params = (token_address,)
-        result = await self.db_pool.read(query, params)
+        result = await self.db_pool.read(CREATION_UNIXTIME_QUERY, params, cache=True)
         return result[0][0] if result else None
 
     async def insert_into_tradeable_assets_info(self, entry):
@@ -127,11 +255,9 @@ class Universe:
         log_general.info(f"token_address: {entry.get('token_address')} added to tradeable_assets and set true for universe_id: {self.universe_id}")
 
     async def insert_into_tradeable_asset_prices(self, token_address, entries, interval):
-        sql = '''INSERT INTO tradeable_asset_prices (token_address, unixtime, open, high, low, close, volume, interval)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
-        for data_point in entries:
-            params = (token_address, data_point["unixTime"], data_point["o"], data_point["h"], data_point["l"], data_point["c"], data_point["v"], interval)
-            await self.db_pool.write(sql, params)
+        params = [(token_address, data_point["unixTime"], data_point["o"], data_point["h"], data_point["l"], data_point["c"], data_point["v"], interval)
+                  for data_point in entries]
+        await self.db_pool.write(UPSERT_PRICES_SQL, params)
         log_general.info(f"{len(entries)} OHCLV data points added to tradeable_asset_prices for token_address: {token_address} interval: {interval}")
 
     async def fill_entry(self, coin):
@@ -143,9 +269,9 @@ class Universe:
         token_address = convert_or_default(coin.get('address'), str, '_')
         symbol = convert_or_default(coin.get('symbol'), str, '_')
 
-        security_info = await self.fetch_token_security_info(token_address) 
-        top10holderspct = convert_or_default(security_info['data'].get('top_10_holders_pct'), float, 0)
-        creation_time = convert_or_default(security_info['data'].get('creationTime'), int, 0)
+        security_data = await self.metadata_cache.lookup(token_address, self.metadata_ttls, self.fetch_token_security_data) or {}
+        top10holderspct = convert_or_default(security_data.get('top_10_holders_pct'), float, 0)
+        creation_time = convert_or_default(security_data.get('creation_time'), int, 0)
 
         entry = {
             'token_address': token_address, 'symbol': symbol, 'name': name, 'volume': volume,
@@ -160,17 +286,47 @@ class Universe:
 
         return entry, preliminaries
 
-    @handle_aiohttp_session()
+    async def page_token_list(self, lookups):
+        """ Walks the token list with up to token_list_prefetch_pages requests in flight, queueing a fill_entry task per coin in listing order and then None """
+        offsets = iter(range(0, self.api_token_fetch_limit + 1, self.page_limit))
+        pages = deque(asyncio.create_task(self.fetch_token_list_page(offset)) for offset in itertools.islice(offsets, self.token_list_prefetch_pages))
+        min_mc = self.market_cap_bins[0][0]
+        sorted_by_market_cap = self.token_list_sort_by == 'mc' and self.token_list_sort_type == 'desc'
+        try:
+            while pages:
+                coins = await pages.popleft()
+                if not coins:
+                    break
+                pages.extend(asyncio.create_task(self.fetch_token_list_page(offset)) for offset in itertools.islice(offsets, 1))
+                tokens = coins['data']['tokens']
+                for coin in tokens:
+                    lookups.put_nowait(asyncio.create_task(self.fill_entry(coin)))
+                if len(tokens) < self.page_limit:
+                    break
+                # every later page holds smaller market caps, none of which can land in a bin
+                if sorted_by_market_cap and convert_or_default(tokens[-1].get('mc'), float, 0) <= min_mc:
+                    log_general.info(f"Token list paging stopped early below market cap {min_mc:,} for universe_id: {self.universe_id}")
+                    break
+        finally:
+            for page in pages:
+                page.cancel()
+            lookups.put_nowait(None)
+
+    @handle_aiohttp_session
     async def fetch_coins_by_market_cap(self):
         universe = {n: [] for n in range(1, len(self.market_cap_bins) + 1)}
         min_mc, max_mc = self.market_cap_bins[0][0], self.market_cap_bins[-1][1]
-        offset = 0
-        while offset <= self.api_token_fetch_limit:
-            coins = await self.fetch_token_list_page(offset)
-            if not coins:
-                break
-            for coin in coins['data']['tokens']:
-                entry, preliminaries = await self.fill_entry(coin)
+        # pages are fetched ahead while security lookups run under the semaphore; entries are consumed in listing
+        # order so the universe does not depend on response timing
+        lookups = asyncio.Queue()
+        pager = asyncio.create_task(self.page_token_list(lookups))
+        cache = self.metadata_cache
+        hits, misses = cache.hits, cache.misses
+        token_count = 0
+        try:
+            while (lookup := await lookups.get()) is not None:
+                entry, preliminaries = await lookup
+                token_count += 1
                 market_cap = entry.get('market_cap')
                 if await self.token_exists_in_database(entry.get('token_address')):
                     await self.insert_into_tradeable_assets_info(entry)
@@ -179,8 +335,15 @@ class Universe:
                         if lower_bound <= market_cap < upper_bound:
                             universe[idx].append(entry)
                             break
-            offset += 50
-        log_general.info(f"Queried {self.api_token_fetch_limit + 50} tokens from birdeye with sort_by: {self.token_list_sort_by} and sort_type: {self.token_list_sort_type} for universe_id: {self.universe_id}")
+            await pager
+        finally:
+            pager.cancel()
+            while not lookups.empty():
+                lookup = lookups.get_nowait()
+                if lookup is not None:
+                    lookup.cancel()
+        log_general.info(f"Token metadata cache: {cache.hits - hits} hits, {cache.misses - misses} misses for universe_id: {self.universe_id}")
+        log_general.info(f"Queried {token_count} tokens from birdeye with sort_by: {self.token_list_sort_by} and sort_type: {self.token_list_sort_type} for universe_id: {self.universe_id}")
         return universe
 
     def filter_universe_by_age_and_security(self, universe):
@@ -240,35 +403,54 @@ class Universe:
         security_filtered_universe = self.filter_universe_by_age_and_security(universe)
         final_filtered_universe = self.filter_universe_by_volume_and_liquidity(security_filtered_universe)
         log_general.info(format_universe_composition(self.market_cap_bins, final_filtered_universe))
-        await self.set_currently_tradeable_to_false()
+        await self.apply_universe_membership(final_filtered_universe)
 
-        for asset in final_filtered_universe:
-            token_address = asset['token_address']
-            if await self.token_exists_in_database(token_address):
-                await self.set_currently_tradeable_to_true(token_address)
-            else:
-                await self.insert_into_tradaeble_assets(asset)
-                await self.insert_into_tradeable_assets_info(asset)
+    async def apply_universe_membership(self, assets):
+        """ Makes assets the universe's tradeable set in one transaction, inserting unseen tokens and flipping only changed flags """
+        now = int(time.time())
+        token_addresses = json.dumps([asset['token_address'] for asset in assets])
+        # info rows first: once the assets are inserted, tokens seen for the first time can no longer be told apart
+        new_asset_info = [(now, asset['token_address'], asset['top_10_holders_pct'], asset['volume'], asset['volume_change_pct'],
+                           asset['market_cap'], asset['liquidity'], asset['volume_pct_market_cap'], asset['token_address']) for asset in assets]
+        new_assets = [(asset['token_address'], asset['name'], asset['symbol'], self.platform, asset['creation_time']) for asset in assets]
+        left, _, inserted, joined = await self.db_pool.transaction([
+            (self.leave_universe_sql, (token_addresses,)),
+            (self.insert_new_asset_info_sql, new_asset_info),
+            (self.insert_new_asset_sql, new_assets),
+            (self.join_universe_sql, (token_addresses,)),
+        ])
+        log_general.info(f"universe_id: {self.universe_id} membership refreshed: {left} tokens left, {joined} rejoined, {inserted} added to tradeable_assets")
+
+    async def ingest_ohlcv(self, token_address, interval, unix_time_start, unix_time_end) -> int:
+        async with self.ohlcv_fetch_semaphore:
+            response = await self.fetch_new_ohlcv_data(token_address, interval, unix_time_start, unix_time_end)
+        entries = ((response or {}).get('data') or {}).get('items') or []
+        if entries:
+            await self.insert_into_tradeable_asset_prices(token_address, entries, interval)
+        return len(entries)
 
-    @handle_aiohttp_session()
+    @handle_aiohttp_session
     async def update_tradeable_asset_prices(self, interval):
-        token_addresses = await self.get_all_currently_tradeable_assets()
+        unix_time_end = int(time.time())
+        interval_seconds = interval_to_seconds(interval)
+        windows = {}
+        for token_address, (creation_unixtime, last_update_unix) in (await self.last_ohlcv_update_unixtimes(interval)).items():
+            if last_update_unix is None:
+                # first fetch reaches back to creation, at most one week
+                last_update_unix = max(creation_unixtime or unix_time_end, unix_time_end - interval_to_seconds('1W'))
+            if unix_time_end - last_update_unix >= interval_seconds:
+                windows[token_address] = last_update_unix
 
-        for token_address in token_addresses:
-            unix_time_end = int(time.time())
-            result = await self.last_ohclv_update_unixtime(self, token_address, interval)
-            if result:
-                last_update_unix = result[0]
+        start = time.perf_counter()
+        results = await asyncio.gather(*[self.ingest_ohlcv(token_address, interval, last_update_unix, unix_time_end)
+                                         for token_address, last_update_unix in windows.items()], return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        candle_count = 0
+        for token_address, result in zip(windows, results):
+            if isinstance(result, Exception):
+                log_general.error(f"OHLCV ingestion failed for token_address: {token_address} interval: {interval}: {result}")
             else:
-                creation_unixtime_result = await self.get_token_creation_unixtime(token_address)
-                creation_unixtime = creation_unixtime_result[0] if creation_unixtime_result else unix_time_end
-                if unix_time_end - creation_unixtime < interval_to_seconds('1W'):
-                    last_update_unix = creation_unixtime
-                else:
-                    last_update_unix = unix_time_end - interval_to_seconds('1W')
-
-            interval_seconds = interval_to_seconds(interval)
-            if unix_time_end - last_update_unix >= interval_seconds:
-                new_ohlcv_data = await self.fetch_new_ohlcv_data(token_address, interval, last_update_unix, unix_time_end)["data"]["items"]
-                if new_ohlcv_data:
-                    await self.insert_into_tradeable_asset_prices(token_address, new_ohlcv_data, interval)
\ No newline at end of file
+                candle_count += result
+        log_general.info(f"Ingested {candle_count} {interval} candles for {len(windows)} tokens in {elapsed:.2f}s "
+                         f"({candle_count / elapsed if elapsed else 0:.0f} candles/s) for universe_id: {self.universe_id}")
+        return candle_count
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+from datastructures import StreamContainer
+from indicators import BOLLINGER, RSI
+
+
+# Window-rescan versions of BOLLINGER and RSI as they were computed before the rolling implementations
+def rescan_bollinger(ohclv, length, std_devs):
+    close = ohclv.close
+    out = np.empty((3, len(close.data)))
+    for idx in range(1, len(close.data)):
+        lag = len(close.data) - 1 - idx
+        middle = close.mean(length=length, lag=lag)
+        std = close.std_dev(length=length, lag=lag)
+        out[:, idx] = (middle + std * std_devs, middle, middle - std * std_devs)
+    return out
+
+
+def rescan_rsi(ohclv, length):
+    close = ohclv.close
+    out = np.empty(len(close.data))
+    for idx in range(1, len(close.data)):
+        lag = len(close.data) - 1 - idx
+        num = close.average_gain(length=length-1, lag=lag+1) * (length - 1) + close.average_gain()
+        denom = close.average_loss(length=length-1, lag=lag+1) * (length - 1) + close.average_loss()
+        div = num / denom if denom != 0 else 0
+        out[idx] = 100 - (100 / (1 + div))
+    return out
+
+
+def generate_ohclv(n_bars, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 10 * np.cumprod(1 + rng.normal(0, 0.02, n_bars))
+    data = pd.DataFrame({
+        'open': close, 'high': close * 1.01, 'low': close * 0.99, 'close': close, 'volume': rng.uniform(1e3, 1e5, n_bars)
+    })
+    return StreamContainer(data)
+
+
+def run_indicator(indi, ohclv, batch):
+    prevs = StreamContainer.from_arrays(ohclv.unixtime, {alias: np.full(len(ohclv.close.data), np.nan) for alias in indi.stream_aliases})
+    if batch:
+        return indi.next(ohclv, prevs)
+    for idx in range(indi.n_self_referential, len(ohclv.close.data)):
+        indi.calculate(ohclv, idx)
+
+
+def timed(func, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(n_bars=2000, repeats=5):
+    ohclv = generate_ohclv(n_bars)
+    print(f"{'indicator':<12}{'lookback':>10}{'rescan (ms)':>14}{'per-bar (ms)':>14}{'rolling (ms)':>14}{'speedup':>10}")
+    for length in (14, 50, 200):
+        cases = [
+            ('BOLLINGER', lambda: rescan_bollinger(ohclv, length, 2), BOLLINGER(length, 2)),
+            ('RSI', lambda: rescan_rsi(ohclv, length), RSI(length)),
+        ]
+        for name, rescan, indi in cases:
+            rescan_time = timed(rescan, repeats)
+            per_bar_time = timed(lambda: run_indicator(indi, ohclv, batch=False), repeats)
+            rolling_time = timed(lambda: run_indicator(indi, ohclv, batch=True), repeats)
+            print(f"{name:<12}{length:>10}{rescan_time * 1e3:>14.2f}{per_bar_time * 1e3:>14.2f}{rolling_time * 1e3:>14.2f}{rescan_time / rolling_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
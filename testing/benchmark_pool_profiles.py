@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+from pooling import DatabaseConnectionPool, TUNING_PROFILES
+
+
+PRICES_DDL = """CREATE TABLE tradeable_asset_prices (token_address TEXT NOT NULL, interval TEXT NOT NULL, unixtime INTEGER NOT NULL,
+                open REAL, high REAL, low REAL, close REAL, volume REAL, PRIMARY KEY (token_address, interval, unixtime)) WITHOUT ROWID"""
+INSERT_PRICE = "INSERT INTO tradeable_asset_prices (token_address, unixtime, open, high, low, close, volume, interval) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+LOOKBACK_QUERY = """SELECT unixtime, open, high, low, close, volume FROM tradeable_asset_prices
+                    WHERE token_address = ? AND interval = ? ORDER BY unixtime DESC LIMIT ?"""
+
+
+def generate_rows(n_tokens, n_bars, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for token in range(n_tokens):
+        close = 10 * np.cumprod(1 + rng.normal(0, 0.02, n_bars))
+        for bar in range(n_bars):
+            rows.append((f'token{token}', 60 * bar, close[bar], close[bar] * 1.01, close[bar] * 0.99, close[bar], 1e4, '1m'))
+    return rows
+
+
+async def run_profile(profile, rows, n_tokens, n_queries, lookback):
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = DatabaseConnectionPool(os.path.join(tmp, 'bench.db'), profile=profile)
+        await pool.write(PRICES_DDL)
+
+        # single-row writes, as issued by the universe ingestion loop
+        start = time.perf_counter()
+        await asyncio.gather(*[pool.write(INSERT_PRICE, row) for row in rows])
+        write_rate = len(rows) / (time.perf_counter() - start)
+
+        # concurrent strategy lookback reads
+        start = time.perf_counter()
+        await asyncio.gather(*[pool.read(LOOKBACK_QUERY, (f'token{i % n_tokens}', '1m', lookback)) for i in range(n_queries)])
+        read_rate = n_queries / (time.perf_counter() - start)
+        await pool.close()
+    return write_rate, read_rate
+
+
+async def main(n_tokens=50, n_bars=400, n_queries=2000, lookback=200):
+    rows = generate_rows(n_tokens, n_bars)
+    print(f"{'profile':<14}{'inserts/s':>14}{'queries/s':>14}")
+    for profile in TUNING_PROFILES:
+        write_rate, read_rate = await run_profile(profile, rows, n_tokens, n_queries, lookback)
+        print(f"{profile:<14}{write_rate:>14.0f}{read_rate:>14.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
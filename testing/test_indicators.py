@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+from datastructures import StreamContainer
+from indicators import Indicator, RSI
+
+
+class PerBarRSI(RSI):
+    calculate_batch = Indicator.calculate_batch
+
+
+def random_closes(seed, shape):
+    rng = np.random.default_rng(seed)
+    return 10 * np.cumprod(1 + rng.normal(0, 0.02, shape), axis=-1)
+
+
+def window(unixtime, close, start, stop):
+    close = np.ascontiguousarray(close[..., start:stop])
+    ohclv = StreamContainer.from_arrays(unixtime[start:stop], {'close': close})
+    prevs = StreamContainer.from_arrays(unixtime[start:stop], {'out': np.full(close.shape, np.nan)})
+    return ohclv, prevs
+
+
+@pytest.mark.parametrize('indicator_class', [RSI, PerBarRSI])
+@pytest.mark.parametrize('offset', [1, 4, 9, 14, 20])
+def test_rsi_resumed_inside_warmup_matches_a_full_run(indicator_class, offset):
+    length, n_bars = 14, 120
+    unixtime, close = np.arange(n_bars) * 60, random_closes(offset, n_bars)
+    full, _, _ = indicator_class(length).next(*window(unixtime, close, 0, n_bars))
+
+    # the state is captured a few bars into the series, then resumed from a window that has slid past the first bars
+    _, _, state = indicator_class(length).next(*window(unixtime, close, 0, offset + 3))
+    resumed, (start_idx, _), _ = indicator_class(length).next(*window(unixtime, close, offset, n_bars), state)
+    assert start_idx == 3
+    assert np.allclose(resumed.out.data[start_idx:], full.out.data[offset + start_idx:], rtol=0, atol=1e-9)
+
+
+def test_rsi_panel_rows_at_different_change_counts_match_full_runs():
+    length, n_rows, n_bars = 14, 5, 80
+    unixtime, close = np.arange(n_bars) * 60, random_closes(3, (n_rows, n_bars))
+    # every row shares the resume bar, but each has absorbed a different number of changes before the window
+    starts = [0, 2, 5, 11, 16]
+    states = [RSI(length).next(*window(unixtime, close[row], start, 20))[2] for row, start in enumerate(starts)]
+    ohclv, prevs = window(unixtime, close, 17, n_bars)
+    RSI(length).next_panel(ohclv, prevs, states)
+    for row, start in enumerate(starts):
+        full, _, _ = RSI(length).next(*window(unixtime, close[row], start, n_bars))
+        assert np.allclose(prevs.out.data[row, 3:], full.out.data[20 - start:], rtol=0, atol=1e-9)
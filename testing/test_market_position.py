@@ -0,0 +1,148 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+from datastructures import MarketPosition, PositionContainer
+
+
+# Single-level port of the exit bookkeeping MarketPosition used before exits were kept sorted: every trailing exit price
+# was rewritten at the current price on the ticks that move it, then compared against the price
+class BaselineLevel:
+    def __init__(self, exit_type, price, pct_trail, profit_target_pct=None):
+        self.exit_type = exit_type
+        self.pct_trail = pct_trail
+        self.stop_loss = exit_type.endswith('stop_loss')
+        self.current_price = self.last_price = self.highest_price = price
+        if exit_type.startswith('triggered'):
+            self.exit_price, self.trigger_price = None, price * (1 + profit_target_pct)
+        else:
+            self.exit_price, self.trigger_price = self._exit_price(price), None
+
+    def _exit_price(self, price):
+        return price * (1 - self.pct_trail) if self.stop_loss else price * (1 + self.pct_trail)
+
+    def update(self, price):
+        self.last_price, self.current_price = self.current_price, price
+        self.highest_price = max(self.highest_price, price)
+        moves = price == self.highest_price or (not self.stop_loss and price < self.last_price)
+        if self.exit_price is None and self.trigger_price is not None and price >= self.trigger_price:
+            self.exit_price = self._exit_price(price)
+            return False
+        if self.exit_price is not None and moves:
+            self.exit_price = self._exit_price(price)
+        if self.exit_price is None:
+            return False
+        return price <= self.exit_price if self.stop_loss else price >= self.exit_price
+
+
+def add_level(position, exit_type, pct_trail, profit_target_pct=None):
+    if exit_type.startswith('triggered'):
+        getattr(position, f'add_{exit_type}')(profit_target_pct, pct_trail)
+    else:
+        getattr(position, f'add_{exit_type}')(pct_trail)
+
+
+def first_exit(prices, update):
+    for tick, price in enumerate(prices):
+        if update(price):
+            return tick
+    return None
+
+
+def random_walk(seed, n=400):
+    rng = np.random.default_rng(seed)
+    return 1.0 * np.cumprod(1 + rng.normal(0, 0.02, n))
+
+
+@pytest.mark.parametrize('exit_type, pct_trail, profit_target_pct', [
+    ('trailing_stop_loss', 0.08, None),
+    ('trailing_take_profit', 0.03, None),
+    ('triggered_trailing_take_profit', 0.03, 0.10),
+])
+def test_levels_added_at_entry_fire_on_the_same_tick_as_before(exit_type, pct_trail, profit_target_pct):
+    for seed in range(20):
+        prices = random_walk(seed)
+        position = MarketPosition('tx', 'token', 1.0, 1.0, 0)
+        add_level(position, exit_type, pct_trail, profit_target_pct)
+        baseline = BaselineLevel(exit_type, 1.0, pct_trail, profit_target_pct)
+        assert first_exit(prices, lambda price: bool(position.update(price))) == first_exit(prices, baseline.update)
+
+
+def test_trailing_stop_added_below_peak_trails_from_its_own_price():
+    position = MarketPosition('tx', 'token', 1.0, 1.0, 0)
+    position.update(2.0)
+    position.update(1.5)
+    position.add_trailing_stop_loss(0.10)
+    assert position.update(1.49) is None
+    assert position.get_exit_condition('trailing_stop_loss', 0)[0] == pytest.approx(1.35)
+    assert position.update(1.6) is None
+    assert position.get_exit_condition('trailing_stop_loss', 0)[0] == pytest.approx(1.44)
+    assert position.update(1.43) == [('trailing_stop_loss', 1, 0)]
+
+
+def test_trailing_take_profit_added_after_a_rebound_uses_its_own_reference():
+    position = MarketPosition('tx', 'token', 1.0, 1.0, 0)
+    position.update(0.9)
+    position.update(0.95)
+    position.add_trailing_take_profit(0.03)
+    assert position.update(0.951) is None
+    assert position.get_exit_condition('trailing_take_profit', 0)[0] == pytest.approx(0.95 * 1.03)
+    assert position.update(0.98) == [('trailing_take_profit', 1, 0)]
+
+
+def test_triggered_trailing_stop_trails_from_the_arming_price():
+    position = MarketPosition('tx', 'token', 1.0, 1.0, 0)
+    position.update(1.5)
+    position.update(1.0)
+    position.add_triggered_trailing_stop_loss(0.20, 0.10)
+    assert position.update(1.27) is None
+    assert position.get_exit_condition('triggered_trailing_stop_loss', 0)[0] == pytest.approx(1.143)
+    assert position.update(1.26) is None
+    assert position.update(1.14) == [('triggered_trailing_stop_loss', 1, 0)]
+
+
+def add_random_levels(positions, rng):
+    draws = [rng.uniform(0.02, 0.3, 3) for _ in range(rng.integers(1, 4))]
+    exit_type = MarketPosition.exit_types[rng.integers(0, 6)]
+    for position in positions:
+        for pct, pct_trail, pct_exit in draws:
+            if exit_type.startswith('triggered'):
+                getattr(position, f'add_{exit_type}')(pct, pct_trail / 3, pct_exit)
+            else:
+                getattr(position, f'add_{exit_type}')(pct_trail, pct_exit)
+
+
+def exit_lists(position):
+    return {exit_type: [list(position.get_exit_condition(exit_type, idx)) for idx in range(len(getattr(position, exit_type)))]
+            for exit_type in MarketPosition.exit_types}
+
+
+def test_update_all_matches_per_position_updates_with_levels_added_mid_walk():
+    rng = np.random.default_rng(7)
+    book = PositionContainer('strategy', capacity=4)
+    reference = {}
+    for i in range(24):
+        token, price = f'token{i}', rng.uniform(1, 10)
+        book.add_position(token, 'tx', price, 1.0, 0)
+        reference[token] = MarketPosition('tx', token, price, 1.0, 0)
+    fired = 0
+    for tick in range(300):
+        tokens = list(book.tokens)
+        prices = np.array([float(book[token].current_price) * (1 + rng.normal(0, 0.03)) if rng.random() < 0.9 else np.nan for token in tokens])
+        triggered = book.update_all(prices)
+        for token, price in zip(tokens, prices):
+            expected = None if np.isnan(price) else reference[token].update(price)
+            assert triggered.get(token) == expected
+            if expected:
+                fired += 1
+                exits = {f'tx{j}': exit for j, exit in enumerate(expected)}
+                book[token].confirm(exits)
+                reference[token].confirm(exits)
+            if rng.random() < 0.05:
+                add_random_levels([book[token], reference[token]], rng)
+            assert np.allclose(book[token].state, reference[token].state, equal_nan=True)
+            assert exit_lists(book[token]) == exit_lists(reference[token])
+    assert fired > 50
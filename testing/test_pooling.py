@@ -0,0 +1,33 @@
+import os
+import sys
+import asyncio
+import sqlite3
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+pytest.importorskip('aiosqlite')
+pytest.importorskip('aiohttp')
+from pooling import DatabaseConnectionPool
+
+
+def run_with_pool(db_path, test, **kwargs):
+    async def run():
+        pool = DatabaseConnectionPool(db_path, **kwargs)
+        try:
+            await test(pool)
+        finally:
+            await pool.close()
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('group_commit', [True, False])
+def test_reads_fail_instead_of_hanging_when_the_database_cannot_be_opened(tmp_path, group_commit):
+    async def test(pool):
+        with pytest.raises(sqlite3.OperationalError):
+            await asyncio.wait_for(pool.read("SELECT 1"), timeout=5)
+        with pytest.raises(sqlite3.OperationalError):
+            await asyncio.wait_for(pool.write("CREATE TABLE t (x INTEGER)"), timeout=5)
+        with pytest.raises(sqlite3.OperationalError):
+            await asyncio.wait_for(anext(pool.read_chunks("SELECT 1")), timeout=5)
+    run_with_pool(str(tmp_path / 'missing' / 'trading_algo.db'), test, read_workers=2, group_commit=group_commit)
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+pytest.importorskip('aiosqlite')
+pytest.importorskip('aiohttp')
+from pooling import ReadCache
+
+
+def cache_read(cache, query, params=()):
+    tables = cache.read_tables(query)
+    cache.put((query, params), tables, cache.generation(tables), [(1,)])
+
+
+def test_evicted_keys_leave_the_table_index():
+    cache = ReadCache(max_entries=4)
+    for i in range(100):
+        cache_read(cache, "SELECT p.unixtime FROM tradeable_asset_prices p JOIN tradeable_assets t ON t.token_address = p.token_address WHERE p.token_address = ?", (i,))
+    assert len(cache.entries) == 4
+    assert {table: len(keys) for table, keys in cache.keys_by_table.items()} == {'tradeable_asset_prices': 4, 'tradeable_assets': 4}
+
+
+def test_invalidating_one_table_drops_the_entry_from_the_others():
+    cache = ReadCache()
+    cache_read(cache, "SELECT 1 FROM tradeable_asset_prices p JOIN tradeable_assets t ON t.token_address = p.token_address")
+    cache_read(cache, "SELECT 1 FROM tradeable_assets WHERE token_address = ?", ('token',))
+    cache.invalidate("INSERT INTO tradeable_asset_prices (token_address) VALUES (?)")
+    assert list(cache.entries) == [("SELECT 1 FROM tradeable_assets WHERE token_address = ?", ('token',))]
+    assert cache.keys_by_table == {'tradeable_assets': {("SELECT 1 FROM tradeable_assets WHERE token_address = ?", ('token',))}}
+    assert cache.get(("SELECT 1 FROM tradeable_assets WHERE token_address = ?", ('token',))) == [(1,)]
@@ -0,0 +1,84 @@
+import os
+import sys
+import asyncio
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+pytest.importorskip('aiosqlite')
+pytest.importorskip('solana')
+from migrations import connect, migrate, check_query_plans
+from indicators import init_indicator
+from pooling import DatabaseConnectionPool
+from strategy import Strategy
+
+
+class RangeStrategy(Strategy):
+    async def next(self):
+        pass
+
+
+def run_with_strategy(tmp_path, test, indicators=None):
+    db_path = str(tmp_path / 'trading_algo.db')
+    conn = connect(db_path)
+    migrate(conn)
+    conn.close()
+
+    async def run():
+        pool = DatabaseConnectionPool(db_path, read_workers=2)
+        strategy = RangeStrategy({'strategy_id': 'test', 'universe_id': 'test_universe', 'lookback_period': {'5m': 10},
+                                  'indicators': indicators or {'5m': {}}}, pool)
+        try:
+            await strategy.init_indicators()
+            await test(strategy, pool)
+        finally:
+            await pool.close()
+    asyncio.run(run())
+
+
+async def insert_prices(pool, n_bars):
+    rows = [('token', unixtime * 300, 1.0, 1.1, 0.9, 1.0 + unixtime, 10.0, '5m') for unixtime in range(n_bars)]
+    await pool.write("INSERT INTO tradeable_asset_prices (token_address, unixtime, open, high, low, close, volume, interval) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def test_bounded_range_reads_use_the_pooled_readers(tmp_path):
+    async def test(strategy, pool):
+        await insert_prices(pool, 20)
+        async def no_dedicated_connections(*args, **kwargs):
+            raise AssertionError("range read opened a dedicated connection")
+            yield
+        pool.read_chunks = no_dedicated_connections
+        data = await strategy.fetch_ohlcv_data_range('token', '5m', 600, 1500)
+        assert list(data['unixtime']) == [600, 900, 1200, 1500]
+        assert np.allclose(data['close'], [3.0, 4.0, 5.0, 6.0])
+        assert (await strategy.fetch_indicators_data_range('token', '5m', 600, 1500))['unixtime'].tolist() == [600, 900, 1200, 1500]
+    run_with_strategy(tmp_path, test)
+
+
+def test_indicator_columns_with_float_arguments_round_trip(tmp_path):
+    async def test(strategy, pool):
+        await insert_prices(pool, 5)
+        cols = strategy.interval_indicator_cols['5m']
+        assert 'BOLLINGER_10_2.5_STREAM_1' in cols
+        entries = pd.DataFrame({'token_address': 'token', 'unixtime': [0, 300, 600]})
+        for position, col in enumerate(cols):
+            entries[col] = [position + 0.5, position + 1.5, np.nan]
+        strategy.new_indicator_database_entries = {'5m': entries}
+        await strategy.insert_into_indicator_database()
+
+        joined = await strategy.fetch_joined_ohlcv_and_indicators_data('token', '5m', 5)
+        assert joined.loc[300, cols].tolist() == [position + 1.5 for position in range(len(cols))]
+        assert joined.loc[[600, 900, 1200], cols].isna().all().all()
+        ranged = await strategy.fetch_indicators_data_range('token', '5m', 0, 300)
+        assert ranged[cols].to_numpy().tolist() == [[position + offset for position in range(len(cols))] for offset in (0.5, 1.5)]
+    run_with_strategy(tmp_path, test, indicators={'5m': {'EMA': [[7]], 'BOLLINGER': [[10, 2.5]]}})
+
+
+def test_query_plans_hold_for_indicators_with_float_arguments(tmp_path):
+    conn = connect(str(tmp_path / 'trading_algo.db'))
+    migrate(conn)
+    check_query_plans(conn, indis=[init_indicator('EMA', 7), init_indicator('BOLLINGER', 10, 2.5)], interval='5m')
+    conn.close()
@@ -0,0 +1,42 @@
+import os
+import sys
+import warnings
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+from datastructures import Stream
+
+
+def point_query(data, name, length, lag):
+    # an empty window (lag past the start of the stream) is NaN in the rolling series
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        try:
+            return getattr(Stream(data), name)(length, lag)
+        except ValueError:
+            return np.nan
+
+
+@pytest.mark.parametrize('name', ['mean', 'std_dev', 'max', 'min'])
+@pytest.mark.parametrize('length, lag', [(1, 0), (3, 0), (3, 1), (5, 2), (12, 0), (12, 3)])
+def test_rolling_series_match_the_point_queries(name, length, lag):
+    data = np.random.default_rng(length * 10 + lag).normal(10, 1, 40)
+    rolling = {'mean': 'rolling_mean', 'std_dev': 'rolling_std', 'max': 'rolling_max', 'min': 'rolling_min'}[name]
+    series = getattr(Stream(data), rolling)(length, lag)
+    expected = [point_query(data[:i + 1], name, length, lag) for i in range(len(data))]
+    assert np.allclose(series, expected, equal_nan=True)
+
+
+def test_rolling_series_match_the_reported_cases():
+    stream = Stream(np.arange(10, dtype=float))
+    assert stream.rolling_mean(3)[-1] == stream.mean(3) == 7.5
+    assert stream.rolling_max(3, lag=1)[-1] == stream.max(3, lag=1) == 7
+
+
+def test_cross_stream_cache_is_not_shared_with_a_new_stream():
+    stream = Stream(np.array([1.0, 2.0, 3.0, 4.0]))
+    for level in (0.0, 10.0):
+        # each throwaway stream is freed straight away, so the next one can land at the same address
+        assert stream.above_series(Stream(np.full(4, level))).all() == (level == 0.0)
@@ -0,0 +1,52 @@
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'soltrade'))
+
+pytest.importorskip('aiosqlite')
+pytest.importorskip('solana')
+from migrations import connect, migrate
+from pooling import DatabaseConnectionPool
+from universe import TokenMetadataCache
+
+
+def run_with_pool(tmp_path, test):
+    db_path = str(tmp_path / 'trading_algo.db')
+    conn = connect(db_path)
+    migrate(conn)
+    conn.close()
+
+    async def run():
+        pool = DatabaseConnectionPool(db_path, read_workers=2)
+        try:
+            await test(pool)
+        finally:
+            await pool.close()
+    asyncio.run(run())
+
+
+def test_null_security_fields_are_cached_until_their_ttl(tmp_path):
+    ttls = {'creation_time': None, 'top_10_holders_pct': 3600}
+    fetched = []
+
+    async def fetch(token_address):
+        fetched.append(token_address)
+        return {'creationTime': None, 'top_10_holders_pct': None}
+
+    async def test(pool):
+        cache = TokenMetadataCache(pool)
+        for _ in range(3):
+            assert await cache.lookup('token', ttls, fetch) == {'creation_time': None, 'top_10_holders_pct': None}
+        assert fetched == ['token'] and (cache.hits, cache.misses) == (2, 1)
+
+        # the absence is persisted with its fetch time, so a fresh cache warmed from the database still hits
+        warmed = TokenMetadataCache(pool)
+        await warmed.warm()
+        assert warmed.get('token', ttls) == {'creation_time': None, 'top_10_holders_pct': None}
+
+        cache.entries['token'] = cache.entries['token'][:-1] + (cache.entries['token'][-1] - 7200,)
+        await cache.lookup('token', ttls, fetch)
+        assert fetched == ['token', 'token']
+    run_with_pool(tmp_path, test)